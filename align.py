@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+
+# numpy datetime64 unit of each time resolution; casting to a coarser unit floors to the start of the bucket
+RESOLUTION_UNITS = {'hour': 'h', 'day': 'D', 'month': 'M', 'year': 'Y'}
+
+
+# Start of the time_resolution bucket each time falls in
+def floor_times(times, time_resolution):
+    return np.asarray(times, dtype='datetime64[s]').astype(f'datetime64[{RESOLUTION_UNITS[time_resolution]}]')
+
+
+# Mean value per bucket of one (time, value) series, as sorted unique buckets and their means.
+# Series finer than the resolution (e.g. hourly rows aligned by day) are averaged into their bucket.
+def bucket_means(times, values, time_resolution):
+    buckets = floor_times(times, time_resolution)
+    values = np.asarray(values, dtype='float64')
+    keep = ~np.isnat(buckets)
+    buckets, values = buckets[keep], values[keep]
+    order = np.argsort(buckets, kind='stable')
+    buckets, values = buckets[order], values[order]
+    unique_buckets, first = np.unique(buckets, return_index=True)
+    if len(unique_buckets) == len(buckets):
+        return unique_buckets, values
+    present = ~np.isnan(values)
+    sums = np.add.reduceat(np.where(present, values, 0.0), first)
+    counts = np.add.reduceat(present.astype('int64'), first)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return unique_buckets, np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+
+
+# Join any number of (time, value) DataFrames on a regular time_resolution grid into one wide table indexed
+# by bucket start, one column per series. Each series is placed with a sorted searchsorted join on the grid,
+# so the cost is O(n log n) in the number of rows with no per-row Python work.
+# how='inner' keeps only buckets where every series has a value.
+def align_series(series: dict, time_resolution, start=None, end=None, how='outer'):
+    unit = RESOLUTION_UNITS[time_resolution]
+    bucketed = {name: bucket_means(df['time'].to_numpy(), df['value'].to_numpy(), time_resolution)
+                for name, df in series.items()}
+
+    # Regular grid covering all series, or [start, end) when given
+    non_empty = [buckets for buckets, _ in bucketed.values() if len(buckets)]
+    if start is not None:
+        first = floor_times([start], time_resolution)[0]
+    else:
+        first = min(buckets[0] for buckets in non_empty) if non_empty else None
+    if end is not None:
+        last = floor_times([end], time_resolution)[0]
+    else:
+        last = max(buckets[-1] for buckets in non_empty) + np.timedelta64(1, unit) if non_empty else None
+    if first is None or last is None:
+        grid = np.array([], dtype=f'datetime64[{unit}]')
+    else:
+        grid = np.arange(first, last, dtype=f'datetime64[{unit}]')
+
+    columns = {}
+    for name, (buckets, means) in bucketed.items():
+        column = np.full(len(grid), np.nan)
+        inside = (buckets >= grid[0]) & (buckets <= grid[-1]) if len(grid) else np.zeros(len(buckets), bool)
+        column[np.searchsorted(grid, buckets[inside])] = means[inside]
+        columns[name] = column
+
+    table = pd.DataFrame(columns, index=pd.DatetimeIndex(grid.astype('datetime64[s]'), name='time'))
+    if how == 'inner':
+        table = table.dropna(how='any')
+    return table
@@ -0,0 +1,559 @@
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+# Benchmark of the ETL scripts on seeded synthetic data shaped like the real sources.
+#
+#   python benchmark.py [--targets finance,weather,elmaps,plot] [--rows 10000,100000|all] [--seed 0]
+#                       [--loader insert|infile] [--mysql] [--baseline results.jsonl] [--tolerance 0.2]
+#
+# --rows all runs every scale in SCALES, from 10k up to 10M rows.
+# Each target runs at each scale in its own process, so peak memory is per run. The stages are timed by the
+# metrics instrumentation of the scripts (metrics.py). By default the scripts write to a stand-in connection
+# that accepts every statement and keeps nothing, which times the Python side of every stage without a
+# database server; --mysql writes to the databases configured in db.py instead. The plot_data read path runs
+# against a local SQLite copy of the generated weather and Electricity Maps rows, or with --mysql against the rows
+# the weather and elmaps targets loaded, where its queries are also timed as full scans against index seeks.
+# The summary per stage and table is appended to output/benchmark/results.jsonl; with --baseline, stages that
+# got slower than the baseline by more than the tolerance are reported and the exit code is 1.
+
+OUTPUT_DIR = './output/benchmark'
+FIXTURE_DIR = os.path.join(OUTPUT_DIR, 'fixtures')
+RESULTS_FILE = os.path.join(OUTPUT_DIR, 'results.jsonl')
+TARGETS = ['finance', 'weather', 'elmaps', 'plot']
+# Scales of --rows all
+SCALES = [10000, 100000, 1000000, 10000000]
+# Rows generated and written per batch, so generating 10M rows does not need 10M rows in memory
+BATCH_ROWS = 1000000
+
+
+def rng(seed, *stream):
+    return np.random.default_rng([seed, *stream])
+
+
+def money(values):
+    return pd.Series(values).map('${:.2f}'.format)
+
+
+# ***  Finance (Kaggle transactions-fraud-datasets)  ***
+
+MCC_CODES = np.arange(1711, 9403, 77)
+USE_CHIP = np.array(['Swipe Transaction', 'Chip Transaction', 'Online Transaction'])
+STATES = np.array(['CA', 'TX', 'NY', 'FL', 'IL', 'PA', 'OH', 'GA', 'NC', 'MI', 'ND', 'IA'])
+CITIES = np.array([f'City {i}' for i in range(500)])
+ERRORS = np.array(['Bad PIN', 'Insufficient Balance', 'Technical Glitch', 'Bad CVV', 'Bad Expiration'])
+
+
+def generate_finance(directory, rows, seed=0):
+    os.makedirs(directory, exist_ok=True)
+    users = max(100, min(2000, rows // 100))
+    cards = 3 * users
+
+    r = rng(seed, 0)
+    birth_year = r.integers(1930, 2005, users)
+    pd.DataFrame({'id': np.arange(users),
+                  'current_age': 2020 - birth_year,
+                  'retirement_age': r.integers(60, 75, users),
+                  'birth_year': birth_year,
+                  'birth_month': r.integers(1, 13, users),
+                  'gender': r.choice(['Female', 'Male'], users),
+                  'address': [f'{n} Main Street' for n in r.integers(1, 9999, users)],
+                  'latitude': r.uniform(25, 48, users).round(2),
+                  'longitude': r.uniform(-124, -67, users).round(2),
+                  'per_capita_income': money(r.integers(10000, 80000, users)).str[:-3],
+                  'yearly_income': money(r.integers(20000, 160000, users)).str[:-3],
+                  'total_debt': money(r.integers(0, 300000, users)).str[:-3],
+                  'credit_score': r.integers(480, 850, users),
+                  'num_credit_cards': r.integers(1, 9, users)}).to_csv(os.path.join(directory, 'users_data.csv'),
+                                                                       index=False)
+
+    r = rng(seed, 1)
+    card_clients = r.integers(0, users, cards)
+    expires = pd.Series(r.integers(1, 13, cards)).map('{:02d}'.format) + '/' + pd.Series(
+        r.integers(2020, 2030, cards)).astype(str)
+    opened = pd.Series(r.integers(1, 13, cards)).map('{:02d}'.format) + '/' + pd.Series(
+        r.integers(1995, 2020, cards)).astype(str)
+    pd.DataFrame({'id': np.arange(cards),
+                  'client_id': card_clients,
+                  'card_brand': r.choice(['Visa', 'Mastercard', 'Amex', 'Discover'], cards),
+                  'card_type': r.choice(['Debit', 'Credit', 'Debit (Prepaid)'], cards),
+                  'card_number': r.integers(4 * 10 ** 15, 5 * 10 ** 15, cards),
+                  'expires': expires,
+                  'cvv': r.integers(100, 1000, cards),
+                  'has_chip': r.choice(['YES', 'NO'], cards, p=[0.9, 0.1]),
+                  'num_cards_issued': r.integers(1, 4, cards),
+                  'credit_limit': money(r.integers(0, 50000, cards)).str[:-3],
+                  'acct_open_date': opened,
+                  'year_pin_last_changed': r.integers(2000, 2020, cards),
+                  'card_on_dark_web': 'No'}).to_csv(os.path.join(directory, 'cards_data.csv'), index=False)
+
+    with open(os.path.join(directory, 'mcc_codes.json'), 'w', encoding='utf8') as f:
+        json.dump({str(code): f'Merchant category {code}' for code in MCC_CODES}, f)
+
+    # Transactions one minute apart, written in batches; two thirds of them get a fraud label
+    labels = open(os.path.join(directory, 'train_fraud_labels.json'), 'w', encoding='utf8')
+    labels.write('{"target": {')
+    first_label = True
+    for batch, start in enumerate(range(0, rows, BATCH_ROWS)):
+        n = min(BATCH_ROWS, rows - start)
+        r = rng(seed, 2, batch)
+        ids = np.arange(start, start + n) + 7475327
+        card_ids = r.integers(0, cards, n)
+        online = r.random(n) < 0.1
+        amounts = r.lognormal(3.5, 1.2, n).round(2) * np.where(r.random(n) < 0.05, -1, 1)
+        errors = np.where(r.random(n) < 0.02, r.choice(ERRORS, n), '')
+        pd.DataFrame({'id': ids,
+                      'date': (np.datetime64('2010-01-01T00:00') + np.arange(start, start + n)
+                               .astype('timedelta64[m]')).astype('datetime64[s]').astype(str),
+                      'client_id': card_clients[card_ids],
+                      'card_id': card_ids,
+                      'amount': pd.Series(amounts).map('${:.2f}'.format),
+                      'use_chip': np.where(online, USE_CHIP[2], r.choice(USE_CHIP[:2], n)),
+                      'merchant_id': r.integers(1, 100000, n),
+                      'merchant_city': np.where(online, 'ONLINE', r.choice(CITIES, n)),
+                      'merchant_state': np.where(online, '', r.choice(STATES, n)),
+                      'zip': np.where(online, '', (r.integers(1000, 99999, n)).astype(str) + '.0'),
+                      'mcc': r.choice(MCC_CODES, n),
+                      'errors': errors}).to_csv(os.path.join(directory, 'transactions_data.csv'), index=False,
+                                                mode='w' if start == 0 else 'a', header=(start == 0))
+
+        labelled = ids[r.random(n) < 2 / 3]
+        fraud = np.where(r.random(len(labelled)) < 0.0015, 'Yes', 'No')
+        if len(labelled):
+            pairs = ', '.join(f'"{i}": "{label}"' for i, label in zip(labelled.tolist(), fraud.tolist()))
+            labels.write(pairs if first_label else ', ' + pairs)
+            first_label = False
+    labels.write('}}')
+    labels.close()
+
+
+# ***  DMI climate data (JSON lines of GeoJSON features)  ***
+
+DMI_PARAMETERS = ['mean_wind_speed', 'mean_cloud_cover', 'mean_temp', 'mean_pressure']
+
+
+# DMI observations as a DataFrame of the feature properties: per parameter consecutive hours, with every 24th
+# row a daily value
+def dmi_frame(rows, seed=0, batch=0, start=0):
+    r = rng(seed, 3, batch)
+    index = np.arange(start, start + rows)
+    parameter = np.array(DMI_PARAMETERS)[index % len(DMI_PARAMETERS)]
+    step = index // len(DMI_PARAMETERS)
+    daily = step % 25 == 24
+    hours = np.datetime64('2000-01-01T00', 'h') + np.where(daily, (step // 25) * 24, step - step // 25)
+    start_times = np.where(daily, hours.astype('datetime64[D]').astype('datetime64[h]'), hours)
+    end_times = start_times + np.where(daily, 24, 1).astype('timedelta64[h]')
+    return pd.DataFrame({'from': start_times.astype('datetime64[s]'),
+                         'to': end_times.astype('datetime64[s]'),
+                         'timeResolution': np.where(daily, 'day', 'hour'),
+                         'parameterId': parameter,
+                         'value': r.normal(8, 4, rows).round(1)})
+
+
+def generate_dmi(directory, rows, seed=0, rows_per_file=100000):
+    os.makedirs(directory, exist_ok=True)
+    for batch, start in enumerate(range(0, rows, rows_per_file)):
+        df = dmi_frame(min(rows_per_file, rows - start), seed, batch, start)
+        times_from = df['from'].dt.strftime('%Y-%m-%dT%H:%M:%S+00:00')
+        times_to = df['to'].dt.strftime('%Y-%m-%dT%H:%M:%S+00:00')
+        with open(os.path.join(directory, f'{batch:05d}.txt'), 'w', encoding='utf8') as f:
+            for values in zip(times_from, times_to, df['timeResolution'], df['parameterId'], df['value']):
+                f.write('{"type": "Feature", "geometry": null, "properties": {"from": "%s", "to": "%s", '
+                        '"timeResolution": "%s", "parameterId": "%s", "qcStatus": "none", "value": %s}}\n'
+                        % values)
+
+
+# ***  Electricity Maps carbon intensity (CSV per zone, year and resolution)  ***
+
+ELMAPS_RESOLUTIONS = {'hourly': 'h', 'daily': 'D', 'monthly': 'M', 'yearly': 'Y'}
+# Zones get at most this many years of hourly rows, so datetimes stay within pandas' range at 10M rows
+ELMAPS_YEARS_PER_ZONE = 30
+
+
+# Electricity Maps files as {file name: DataFrame}; rows is the number of hourly rows over all zones
+def elmaps_frames(rows, seed=0):
+    hours_per_zone = ELMAPS_YEARS_PER_ZONE * 8760
+    zones = max(1, -(-rows // hours_per_zone))
+    frames = {}
+    for zone_index in range(zones):
+        zone = 'DK' if zone_index == 0 else f'Z{zone_index:03d}'
+        r = rng(seed, 4, zone_index)
+        hours = min(hours_per_zone, rows - zone_index * hours_per_zone)
+        times = pd.date_range('1995-01-01', periods=hours, freq='h')
+        hourly = pd.DataFrame({'datetime': times,
+                               'direct': r.normal(200, 80, hours).clip(0).round(2),
+                               'lca': r.normal(260, 80, hours).clip(0).round(2),
+                               'low_carbon': r.uniform(20, 95, hours).round(2),
+                               'renewable': r.uniform(15, 90, hours).round(2)})
+        for resolution, unit in ELMAPS_RESOLUTIONS.items():
+            if unit == 'h':
+                data = hourly
+            else:
+                data = hourly.groupby(hourly['datetime'].values.astype(f'datetime64[{unit}]')).mean()
+                data['datetime'] = data.index.astype('datetime64[s]')
+            for year, part in data.groupby(data['datetime'].dt.year):
+                frames[f'{zone}_{year}_{resolution}.csv'] = pd.DataFrame({
+                    'Datetime (UTC)': part['datetime'].dt.strftime('%Y-%m-%d %H:%M:%S').values,
+                    'Country': 'Denmark',
+                    'Zone Name': zone,
+                    'Zone Id': zone,
+                    'Carbon Intensity gCO₂eq/kWh (direct)': part['direct'].round(2).values,
+                    'Carbon Intensity gCO₂eq/kWh (LCA)': part['lca'].round(2).values,
+                    'Low Carbon Percentage': part['low_carbon'].round(2).values,
+                    'Renewable Percentage': part['renewable'].round(2).values,
+                    'Data Source': 'synthetic',
+                    'Data Estimated': False,
+                    'Data Estimation Method': ''})
+    return frames
+
+
+def generate_elmaps(directory, rows, seed=0):
+    os.makedirs(directory, exist_ok=True)
+    for file_name, df in elmaps_frames(rows, seed).items():
+        df.to_csv(os.path.join(directory, file_name), index=False)
+
+
+# Generate a fixture once per kind, size and seed and reuse it afterwards
+def fixture(kind, rows, seed):
+    directory = os.path.join(FIXTURE_DIR, f'{kind}_{rows}_{seed}')
+    if not os.path.exists(os.path.join(directory, '.complete')):
+        start = time.perf_counter()
+        {'finance': generate_finance, 'dmi': generate_dmi, 'elmaps': generate_elmaps}[kind](directory, rows, seed)
+        open(os.path.join(directory, '.complete'), 'w').close()
+        print(f"Generated {kind} fixture with {rows} rows in {time.perf_counter() - start:.1f} s")
+    return directory
+
+
+# ***  Database stand-in  ***
+
+# Accepts every statement a pyodbc connection to MySQL would and keeps nothing; queries return no rows
+class StandInCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+        self.fast_executemany = False
+
+    def execute(self, query, *params):
+        self.connection.statements += 1
+        return self
+
+    def executemany(self, query, rows):
+        self.connection.statements += 1
+        self.connection.rows += len(rows)
+
+    def fetchone(self):
+        return None
+
+    def fetchall(self):
+        return []
+
+    def fetchmany(self, size=None):
+        return []
+
+    def close(self):
+        pass
+
+
+class StandInConnection:
+    def __init__(self, db=None, local_infile=False):
+        self.db = db
+        self.statements = 0
+        self.rows = 0
+
+    def cursor(self):
+        return StandInCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# ***  Targets, each run in a child process  ***
+
+# With --mysql the loaders are also compared on the first chunk of transactions_data, in a scratch table without
+# foreign keys
+def run_finance(rows, seed, loader, mysql):
+    import data_integration
+    from db import close_pools, get_pool
+    from ddl import TableSchema
+    directory = fixture('finance', rows, seed)
+    if not data_integration.main(loader=loader, use_cache=False, path=directory + '/'):
+        raise RuntimeError("data_integration failed to load the finance fixture")
+
+    if mysql:
+        df = next(data_integration.read_transactions(directory + '/', 500000))
+        with get_pool('datamerge', local_infile=True).connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute("DROP TABLE IF EXISTS `loader_benchmark`")
+            data_integration.create_table(connection, TableSchema.from_df('loader_benchmark', df, ['transaction_id']))
+            data_integration.benchmark_loaders(df, connection, 'loader_benchmark')
+            cursor.execute("DROP TABLE `loader_benchmark`")
+            connection.commit()
+            cursor.close()
+        close_pools()
+
+
+def run_weather(rows, seed, loader, mysql):
+    import read_weather
+    from db import close_pools, get_pool
+    directory = fixture('dmi', rows, seed)
+    with get_pool('weather').connection() as conn:
+        read_weather.conn = conn
+        read_weather.cursor = conn.cursor()
+        read_weather.process_files(directory_path=directory)
+    close_pools()
+
+
+def run_elmaps(rows, seed, loader, mysql):
+    import read_elmaps
+    from db import close_pools, get_pool
+    directory = fixture('elmaps', rows, seed)
+    with get_pool('weather').connection() as conn:
+        read_elmaps.conn = conn
+        read_elmaps.cursor = conn.cursor()
+        read_elmaps.process_files(directory_path=directory)
+    close_pools()
+
+
+# Plot-style range queries timed by ddl.benchmark_index as a full scan and with the indexes, on the rows loaded by
+# the weather and elmaps targets
+INDEX_QUERIES = {'weather_data': ("`timeResolution` = ? AND `parameterId` = ? AND `from` >= ? AND `from` < ?",
+                                  ['hour', 'mean_wind_speed', '2000-02-01', '2000-03-01']),
+                 'elmaps_data': ("`time_resolution` = ? AND `zone` = ? AND `datetime_utc` >= ? AND `datetime_utc` < ?",
+                                 ['hour', 'DK', '1995-02-01', '1995-03-01'])}
+INDEX_STAGES = {'full scan': 'full_scan', 'index': 'index_seek'}
+
+
+# Time the plot_data read path: the hourly series of two DMI parameters and of one Electricity Maps metric of one
+# zone, and their alignment on a daily grid. Without --mysql the rows are copied into a SQLite database first;
+# with --mysql the queries are also timed as full scans against index seeks.
+def run_plot(rows, seed, loader, mysql):
+    import plot_data
+    from db import close_pools, get_pool
+    from ddl import benchmark_index
+    from metrics import stage
+
+    if mysql:
+        pool = get_pool('weather')
+        conn = pool.checkout()
+    else:
+        conn = sqlite3.connect(sqlite_fixture(rows, seed))
+
+    with stage('plot_data', 'query', 'weather_data') as metrics:
+        series = {parameter_id: plot_data.weather_series(conn, 'hour', parameter_id)
+                  for parameter_id in DMI_PARAMETERS[:2]}
+        metrics.add(rows=sum(len(df) for df in series.values()))
+    with stage('plot_data', 'query', 'elmaps_data') as metrics:
+        series['carbon_intensity_direct'] = plot_data.elmaps_series(conn, 'hour', 'carbon_intensity_direct',
+                                                                         zone='DK')
+        metrics.add(rows=len(series['carbon_intensity_direct']))
+    with stage('plot_data', 'align', None) as metrics:
+        aligned = plot_data.align_series(series, 'day')
+        metrics.add(rows=len(aligned))
+
+    if mysql:
+        for table, (where_sql, params) in INDEX_QUERIES.items():
+            for label, seconds in benchmark_index(conn, table, where_sql, params).items():
+                write_timing('ddl', INDEX_STAGES[label], table, seconds)
+        pool.checkin(conn)
+        close_pools()
+    else:
+        conn.close()
+
+
+# Record a timing taken outside metrics.stage (e.g. the best of several runs) in the same format
+def write_timing(script, name, table, seconds, rows=0):
+    from metrics import RUN_ID, peak_rss_mb, write_record
+    write_record({'run_id': RUN_ID, 'script': script, 'stage': name, 'table': table, 'pid': os.getpid(),
+                  'started_at': None, 'seconds': round(seconds, 6), 'rows': rows, 'bytes': 0,
+                  'rows_per_s': round(rows / seconds, 1) if seconds > 0 else None, 'peak_rss_mb': peak_rss_mb(),
+                  'traced_peak_mb': None, 'error': None})
+
+
+def sqlite_fixture(rows, seed):
+    path = os.path.join(FIXTURE_DIR, f'plot_{rows}_{seed}.sqlite')
+    if not os.path.exists(path):
+        build_sqlite(path, rows, seed)
+    return path
+
+
+def build_sqlite(path, rows, seed):
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+    start = time.perf_counter()
+    conn = sqlite3.connect(path + '.tmp')
+    for batch, first in enumerate(range(0, rows, BATCH_ROWS)):
+        df = dmi_frame(min(BATCH_ROWS, rows - first), seed, batch, first)
+        for col in ['from', 'to']:
+            df[col] = df[col].dt.strftime('%Y-%m-%d %H:%M:%S')
+        df.to_sql('weather_data', conn, if_exists='append', index=False)
+    conn.execute("CREATE INDEX idx_weather ON weather_data (timeResolution, parameterId, `from`)")
+    resolutions = {'hourly': 'hour', 'daily': 'day', 'monthly': 'month', 'yearly': 'year'}
+    for file_name, df in elmaps_frames(rows, seed).items():
+        pd.DataFrame({'time_resolution': resolutions[file_name[:-4].rsplit('_', 1)[-1]],
+                      'zone': df['Zone Id'],
+                      'datetime_utc': df['Datetime (UTC)'],
+                      'carbon_intensity_direct': df['Carbon Intensity gCO₂eq/kWh (direct)'],
+                      'carbon_intensity_lca': df['Carbon Intensity gCO₂eq/kWh (LCA)'],
+                      'low_carbon_percentage': df['Low Carbon Percentage'],
+                      'renewable_percentage': df['Renewable Percentage']}).to_sql('elmaps_data', conn,
+                                                                                  if_exists='append', index=False)
+    conn.execute("CREATE INDEX idx_elmaps ON elmaps_data (time_resolution, zone, datetime_utc)")
+    conn.commit()
+    conn.close()
+    os.replace(path + '.tmp', path)
+    print(f"Built SQLite copy with {rows} rows in {time.perf_counter() - start:.1f} s")
+
+
+RUNNERS = {'finance': run_finance, 'weather': run_weather, 'elmaps': run_elmaps, 'plot': run_plot}
+
+
+def child(target, rows, seed, loader, mysql):
+    if not mysql:
+        from db import set_connection_factory
+        set_connection_factory(StandInConnection)
+    RUNNERS[target](rows, seed, loader, mysql)
+
+
+# Generate the input of a target, in its own process (--prepare) so generating it neither counts towards the
+# time nor the peak memory of the measured run
+def prepare(target, rows, seed, mysql):
+    if target == 'plot':
+        if not mysql:
+            sqlite_fixture(rows, seed)
+    else:
+        fixture({'finance': 'finance', 'weather': 'dmi', 'elmaps': 'elmaps'}[target], rows, seed)
+
+
+# Run one target at one scale in a fresh process and return its stage records
+def run(target, rows, seed, loader, mysql):
+    command = [sys.executable, __file__, '--prepare', target, str(rows), str(seed), loader]
+    if mysql:
+        command.append('--mysql')
+    subprocess.run(command, check=True)
+    fd, metrics_file = tempfile.mkstemp(suffix='.jsonl')
+    os.close(fd)
+    env = dict(os.environ, METRICS_FILE=metrics_file)
+    env.pop('METRICS_RUN_ID', None)
+    command[2] = '--child'
+    start = time.perf_counter()
+    try:
+        result = subprocess.run(command, env=env, stdout=subprocess.DEVNULL)
+        with open(metrics_file, encoding='utf8') as f:
+            records = [json.loads(line) for line in f if line.strip()]
+    finally:
+        os.remove(metrics_file)
+    if result.returncode != 0:
+        raise RuntimeError(f"Benchmark of {target} at {rows} rows failed with exit code {result.returncode}")
+    print(f"{target} at {rows} rows: {time.perf_counter() - start:.1f} s")
+    return records
+
+
+# Sum the records of a run per stage and table
+def summarize(records, target, rows, seed, loader, mysql, commit):
+    summary = {}
+    for record in records:
+        key = (record['script'], record['stage'], record['table'])
+        entry = summary.setdefault(key, {'target': target, 'rows_generated': rows, 'seed': seed, 'loader': loader,
+                                         'database': 'mysql' if mysql else 'stand-in', 'commit': commit,
+                                         'python': platform.python_version(), 'script': key[0],
+                                         'stage': key[1], 'table': key[2], 'seconds': 0.0, 'rows': 0,
+                                         'bytes': 0, 'peak_rss_mb': None})
+        entry['seconds'] += record['seconds']
+        entry['rows'] += record['rows']
+        entry['bytes'] += record['bytes']
+        if record['peak_rss_mb'] is not None:
+            entry['peak_rss_mb'] = max(entry['peak_rss_mb'] or 0, record['peak_rss_mb'])
+    for entry in summary.values():
+        entry['rows_per_s'] = round(entry['rows'] / entry['seconds'], 1) if entry['seconds'] > 0 else None
+        entry['seconds'] = round(entry['seconds'], 6)
+    return list(summary.values())
+
+
+def summary_key(entry):
+    return entry['target'], entry['rows_generated'], entry['seed'], entry['loader'], entry['database'], \
+        entry['script'], entry['stage'], entry['table']
+
+
+# Stages slower than in the baseline by more than tolerance; the latest baseline entry per key is used
+def regressions(entries, baseline_file, tolerance):
+    with open(baseline_file, encoding='utf8') as f:
+        baseline = {summary_key(entry): entry for entry in map(json.loads, f) if entry}
+    slower = []
+    for entry in entries:
+        before = baseline.get(summary_key(entry))
+        # Stages under 10 ms are too noisy to compare
+        if before is not None and before['seconds'] >= 0.01 and entry['seconds'] > before['seconds'] * (1 + tolerance):
+            slower.append((entry, before))
+    return slower
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def option(args, name, default):
+    return args[args.index(name) + 1] if name in args else default
+
+
+def main(args):
+    targets = option(args, '--targets', ','.join(TARGETS)).split(',')
+    rows_option = option(args, '--rows', '10000,100000')
+    scales = SCALES if rows_option == 'all' else [int(rows) for rows in rows_option.split(',')]
+    seed = int(option(args, '--seed', '0'))
+    loader = option(args, '--loader', 'insert')
+    baseline_file = option(args, '--baseline', None)
+    tolerance = float(option(args, '--tolerance', '0.2'))
+    mysql = '--mysql' in args
+    commit = git_commit()
+
+    entries = []
+    for rows in scales:
+        for target in targets:
+            records = run(target, rows, seed, loader, mysql)
+            entries += summarize(records, target, rows, seed, loader, mysql, commit)
+
+    # Compared before appending, as the baseline may be the results file itself
+    slower = regressions(entries, baseline_file, tolerance) if baseline_file else []
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    with open(RESULTS_FILE, 'a', encoding='utf8') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + '\n')
+
+    table = pd.DataFrame(entries)[['target', 'rows_generated', 'stage', 'table', 'seconds', 'rows', 'rows_per_s',
+                                   'peak_rss_mb']]
+    print(table.to_string(index=False))
+    print(f"Results appended to {RESULTS_FILE}")
+
+    for entry, before in slower:
+        print(f"REGRESSION {entry['target']} {entry['rows_generated']} rows, {entry['stage']} "
+              f"{entry['table']}: {before['seconds']:.3f} s -> {entry['seconds']:.3f} s")
+    if slower:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--prepare']:
+        target, rows, seed, loader = sys.argv[2:6]
+        prepare(target, int(rows), int(seed), '--mysql' in sys.argv[6:])
+    elif sys.argv[1:2] == ['--child']:
+        target, rows, seed, loader = sys.argv[2:6]
+        child(target, int(rows), int(seed), loader, '--mysql' in sys.argv[6:])
+    else:
+        main(sys.argv[1:])
@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+
+# Bump when clean_df or read_csv_spec change their output, so cached cleaned data is rebuilt
+CLEANING_VERSION = 1
+
+# A cleaning spec describes one table. All keys are optional:
+#   'dtypes':     final pandas dtype per column (source names, or the new names of split columns)
+#   'currency':   columns holding '$' amounts; read as text, stripped and cast to their dtype
+#   'month_year': 'MM/YYYY' columns split into (month column, year column)
+#   'bool_maps':  columns mapped to bool with the given {text: bool} dict
+#   'datetimes':  columns parsed as DATETIME
+#   'zero_pad':   columns holding numbers read as text, e.g. '2345.0' -> '02345', padded to width
+#   'rename':     {source name: final name}, applied last
+
+
+# Columns whose final dtype can be produced by read_csv itself
+def parse_dtypes(columns, spec: dict, text_dtype: str = 'str') -> dict:
+    text_columns = (set(spec.get('currency', [])) | set(spec.get('month_year', {}))
+                    | set(spec.get('bool_maps', {})) | set(spec.get('zero_pad', {})))
+    dtypes = spec.get('dtypes', {})
+    return {col: text_dtype if col in text_columns else dtypes.get(col, text_dtype)
+            for col in columns if col not in spec.get('datetimes', [])}
+
+
+# Apply the parts of a spec that read_csv cannot do by itself
+def clean_df(df: pd.DataFrame, spec: dict) -> pd.DataFrame:
+    for col in spec.get('currency', []):
+        df[col] = df[col].str.replace('$', '', regex=False)
+    for col, mapping in spec.get('bool_maps', {}).items():
+        df[col] = df[col].map(mapping).astype(bool)
+    for col, (month_col, year_col) in spec.get('month_year', {}).items():
+        df[month_col] = df[col].str[:2]
+        df[year_col] = df[col].str[3:]
+        df = df.drop(col, axis=1)
+    for col, width in spec.get('zero_pad', {}).items():
+        df[col] = df[col].str.replace('.0', '', regex=False).str.zfill(width)
+    for col in spec.get('datetimes', []):
+        if not pd.api.types.is_datetime64_any_dtype(df[col].dtype):
+            df[col] = pd.to_datetime(df[col])
+
+    # Only cast the columns that are not already in their final dtype
+    casts = {col: dtype for col, dtype in spec.get('dtypes', {}).items()
+             if col in df.columns and str(df[col].dtype) != dtype}
+    if casts:
+        df = df.astype(casts)
+    return df.rename(columns=spec.get('rename', {}))
+
+
+# Nullable integer dtypes from narrowest to widest
+INT_DTYPES = ['Int8', 'Int16', 'Int32', 'Int64']
+
+
+# Downcast a cleaned frame to save memory: text columns with at most max_categories distinct values (and at most
+# one distinct value per two rows) become 'category', integer columns the narrowest nullable integer dtype that
+# holds their range. Columns in keep are left as they are, e.g. key columns whose type must match another table.
+# category_columns fixes which text columns become 'category', e.g. as decided on the first chunk of a file.
+def compact_df(df: pd.DataFrame, max_categories: int = 255, keep=(), category_columns=None) -> pd.DataFrame:
+    casts = {}
+    for col in df.columns:
+        dtype = df[col].dtype
+        if col in keep or pd.api.types.is_bool_dtype(dtype):
+            continue
+        if pd.api.types.is_integer_dtype(dtype):
+            low, high = df[col].min(), df[col].max()
+            for int_dtype in INT_DTYPES:
+                info = np.iinfo(int_dtype.lower())
+                if pd.isna(low) or (info.min <= low and high <= info.max):
+                    break
+            if np.dtype(int_dtype.lower()).itemsize < dtype.itemsize:
+                casts[col] = int_dtype
+        elif category_columns is not None:
+            if col in category_columns:
+                casts[col] = 'category'
+        elif pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype):
+            distinct = df[col].nunique()
+            if distinct <= max_categories and distinct * 2 <= len(df):
+                casts[col] = 'category'
+    return df.astype(casts) if casts else df
+
+
+def _read_csv_chunks(reader, spec: dict):
+    with reader:
+        for chunk in reader:
+            yield clean_df(chunk, spec)
+
+
+# Read a CSV file with typed columns and clean it according to spec.
+# With chunksize set, a generator of cleaned chunks is returned instead of a DataFrame.
+# engine='pyarrow' is faster on large files but needs pyarrow installed and cannot stream.
+def read_csv_spec(file_path: str, spec: dict, chunksize: int = None, engine: str = 'c'):
+    columns = pd.read_csv(file_path, nrows=0).columns
+    # The pyarrow engine turns missing values into 'nan' for 'str' columns, so it reads text as 'string'
+    text_dtype = 'string[pyarrow]' if engine == 'pyarrow' else 'str'
+    kwargs = {'dtype': parse_dtypes(columns, spec, text_dtype),
+              'parse_dates': [col for col in spec.get('datetimes', []) if col in columns]}
+    if chunksize is not None:
+        return _read_csv_chunks(pd.read_csv(file_path, chunksize=chunksize, **kwargs), spec)
+    return clean_df(pd.read_csv(file_path, engine=engine, **kwargs), spec)
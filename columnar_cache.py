@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import time
+
+import pandas as pd
+
+# pyarrow is optional; without it the cache is disabled and every lookup is a miss
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.parquet as parquet
+except ImportError:
+    pa = None
+
+CACHE_DIR = './data/cache/columnar'
+
+
+# On-disk cache of cleaned DataFrames in Arrow format. Feather files are written uncompressed so they can be
+# read back memory-mapped; parquet is smaller on disk but is decoded on read. Entries are evicted when they
+# are older than max_age seconds, or least recently used first when the cache grows beyond max_bytes.
+class ColumnarCache:
+    def __init__(self, directory=CACHE_DIR, max_bytes=10 * 2 ** 30, max_age=30 * 24 * 3600, file_format='feather'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.file_format = file_format
+        self.enabled = pa is not None
+        if not self.enabled:
+            print("pyarrow is not installed; columnar cache disabled.")
+
+    # Cache key from any JSON-serialisable parts, e.g. source file hashes and the cleaning spec
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ('.feather' if self.file_format == 'feather' else '.parquet'))
+
+    # True if an unexpired entry exists at path, which is then marked as recently used; expired entries are removed
+    def fresh(self, path):
+        if not self.enabled or not os.path.exists(path):
+            return False
+        if time.time() - os.path.getmtime(path) > self.max_age:
+            os.remove(path)
+            return False
+        os.utime(path)
+        return True
+
+    def get(self, key):
+        path = self.path(key)
+        if not self.fresh(path):
+            return None
+        if self.file_format == 'feather':
+            return feather.read_table(path, memory_map=True).to_pandas()
+        return parquet.read_table(path, memory_map=True).to_pandas()
+
+    def put(self, key, df: pd.DataFrame):
+        if not self.enabled:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(key)
+        tmp_path = path + '.tmp'
+        df = df.reset_index(drop=True)
+        if self.file_format == 'feather':
+            feather.write_feather(df, tmp_path, compression='uncompressed')
+        else:
+            df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def get_or_compute(self, key, compute):
+        df = self.get(key)
+        if df is None:
+            df = compute()
+            self.put(key, df)
+        return df
+
+    # Stream DataFrame chunks through the cache (feather only). On a hit the record batches are read back
+    # memory-mapped; on a miss the chunks from compute_chunks() are passed on and written as they go by.
+    def chunks(self, key, compute_chunks):
+        path = self.path(key)
+        if not self.enabled or self.file_format != 'feather':
+            yield from compute_chunks()
+            return
+        if self.fresh(path):
+            with pa.memory_map(path) as source:
+                reader = pa.ipc.open_file(source)
+                for i in range(reader.num_record_batches):
+                    yield reader.get_batch(i).to_pandas()
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = path + '.tmp'
+        schema = None
+        writer = None
+        caching = True
+        try:
+            for chunk in compute_chunks():
+                if caching:
+                    try:
+                        table = pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+                        if writer is None:
+                            # Columns that are all missing in the first chunk are assumed to hold strings
+                            schema = pa.schema([field.with_type(pa.string()) if pa.types.is_null(field.type)
+                                                else field for field in table.schema],
+                                               metadata=table.schema.metadata)
+                            table = table.cast(schema)
+                            writer = pa.ipc.new_file(tmp_path, schema)
+                        writer.write_table(table)
+                    except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+                        # A later chunk does not fit the first chunk's schema; stop caching this source
+                        print(f"Not caching {key}: {e}")
+                        caching = False
+                yield chunk
+            if caching and writer is not None:
+                writer.close()
+                writer = None
+                os.replace(tmp_path, path)
+                self.evict()
+        finally:
+            if writer is not None:
+                writer.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    # Remove expired entries, then the least recently used ones until the cache fits in max_bytes
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.tmp'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+                if time.time() - stat.st_mtime > self.max_age:
+                    os.remove(path)
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, path))
+            except FileNotFoundError:
+                # Removed by another process sharing the cache
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
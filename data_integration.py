@@ -1,7 +1,20 @@
 import pyodbc
 import pandas as pd
 import requests
-import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import chain
+
+from cleaning import CLEANING_VERSION, clean_df, compact_df, read_csv_spec
+from columnar_cache import ColumnarCache
+from db import close_pools, get_pool, odbc_init
+from ddl import TableSchema, existing_constraints
+from json_stream import read_object_chunks
+from manifest import file_hash
+from metrics import stage
 
 pd.set_option('display.width', 1000)
 pd.set_option('display.max_columns', None)
@@ -14,18 +27,6 @@ def rest_query(url, **kwargs):
     return response_
 
 
-def odbc_init(db):
-    # Specifying the ODBC driver, server name, database, etc. directly
-    cnxn = pyodbc.connect('DRIVER={MySQL ODBC 8.0 ANSI Driver};SERVER=localhost;DATABASE='
-                          + db + ';UID=brk;PWD=12345678;Charset=utf8')
-
-    # Encoding and decoding
-    cnxn.setdecoding(pyodbc.SQL_CHAR, encoding='utf8')
-    cnxn.setdecoding(pyodbc.SQL_WCHAR, encoding='utf8')
-    cnxn.setencoding(encoding='utf8')
-    return cnxn
-
-
 # Get query as DataFrame
 def df_from_sql(conn, query):
     cursor_ = conn.cursor()
@@ -35,43 +36,57 @@ def df_from_sql(conn, query):
     return pd.DataFrame.from_records(rows, columns=cols)
 
 
-def create_table_from_df(df: pd.DataFrame, connection: pyodbc.Connection, table_name: str):
+# Create a table from its schema; bare=True leaves out the primary key and indexes.
+# Returns True when the table was created, False when it already existed and None when creating it failed.
+def create_table(connection: pyodbc.Connection, schema: TableSchema, bare: bool = False):
     cursor = connection.cursor()
+    try:
+        cursor.execute(f"SHOW TABLES LIKE '{schema.name}'")
+        exists = cursor.fetchone() is not None
+        cursor.execute(schema.create_sql(bare))
+        connection.commit()
+        print(f"Table '{schema.name}' checked/created successfully.")
+        return not exists
+    except Exception as e:
+        print(f"Error creating table '{schema.name}': {e}")
+        return None
 
-    # Dynamically create the SQL CREATE TABLE statement
-    column_definitions = []
-    for col_name, dtype in zip(df.columns, df.dtypes):
-        # Map pandas data types to MySQL data types
-        if pd.api.types.is_bool_dtype(dtype):
-            sql_type = "BOOL"
-        elif pd.api.types.is_integer_dtype(dtype):
-            sql_type = "INT"
-        elif pd.api.types.is_float_dtype(dtype):
-            sql_type = "DOUBLE"
-        elif pd.api.types.is_datetime64_any_dtype(dtype):
-            sql_type = "DATETIME"
-        else:
-            sql_type = "VARCHAR(255)"
-        if column_definitions == []:
-            column_definitions.append(f"`{col_name}` {sql_type} NOT NULL")
-            primary_key = f"`{col_name}`"
-        else:
-            column_definitions.append(f"`{col_name}` {sql_type}")
 
-    column_definitions.append(f"PRIMARY KEY ({primary_key})")
-    create_table_sql = f"""
-    CREATE TABLE IF NOT EXISTS `{table_name}` (
-        {', '.join(column_definitions)}
-    );
-    """
+# Create a table for a DataFrame with the first column as primary key.
+# Returns its schema when the table was created, or None when it already existed or could not be created.
+def create_table_from_df(df: pd.DataFrame, connection: pyodbc.Connection, table_name: str, compact: bool = False):
+    schema = TableSchema.from_df(table_name, df, primary_key=[df.columns[0]], compact=compact)
+    return schema if create_table(connection, schema) else None
+
 
-    # Execute the CREATE TABLE statement
+# Add the keys, indexes and foreign keys of a schema the table does not have yet, in one ALTER TABLE
+def add_constraints(connection: pyodbc.Connection, schema: TableSchema):
+    cursor = connection.cursor()
     try:
-        cursor.execute(create_table_sql)
+        alter_sql = schema.constraints_sql(existing_constraints(connection, schema.name))
+        if alter_sql is None:
+            print(f"Keys of table '{schema.name}' already exist.")
+            return
+        start = time.perf_counter()
+        cursor.execute(alter_sql)
         connection.commit()
-        print(f"Table '{table_name}' checked/created successfully.")
+        print(f"Keys added to table '{schema.name}' in {time.perf_counter() - start:.1f} s.")
     except Exception as e:
-        print(f"Error creating table '{table_name}': {e}")
+        print(f"Error adding keys to table '{schema.name}': {e}")
+    finally:
+        cursor.close()
+
+
+# A table streamed in chunks is created from its first chunk. In compact mode later chunks may hold category
+# values the first one did not; append them to the ENUM columns before the chunk is written.
+def widen_table(df: pd.DataFrame, connection: pyodbc.Connection, schema: TableSchema):
+    alter_sql = schema.widen_sql(df)
+    if alter_sql is None:
+        return
+    cursor = connection.cursor()
+    cursor.execute(alter_sql)
+    cursor.close()
+    print(f"Widened {schema.name}: {' '.join(alter_sql.split())[:200]}")
 
 
 def list_foreign_keys(connection: pyodbc.Connection, write_db: str):
@@ -110,25 +125,119 @@ def add_foreign_key(connection: pyodbc.Connection, table_name: str, column_name:
         print(f"Error creating foreign key on table '{table_name}': {e}")
 
 
-def write_df_to_sql(df: pd.DataFrame, connection: pyodbc.Connection, table_name: str):
+# True when every row was written
+def write_df_to_sql(df: pd.DataFrame, connection: pyodbc.Connection, table_name: str, chunk_size: int = 10000):
     cursor = connection.cursor()
+    cursor.fast_executemany = True
 
     # Generate column names for SQL insert
     columns = ", ".join(df.columns)
     placeholders = ", ".join(["?"] * len(df.columns))
     insert_sql = f"INSERT INTO {table_name} ({columns}) VALUES ({placeholders})"
 
-    # Write rows to the database
+    # Write rows to the database in chunks, one commit per chunk
+    rows_written = 0
+    start = time.perf_counter()
     try:
-        for _, row in df.iterrows():
-            cursor.execute(insert_sql, tuple(row))
+        for chunk_start in range(0, len(df), chunk_size):
+            chunk = df.iloc[chunk_start:chunk_start + chunk_size].astype(object)
+            chunk = chunk.where(chunk.notna(), None)
+            cursor.executemany(insert_sql, list(chunk.itertuples(index=False, name=None)))
+            connection.commit()
+            rows_written += len(chunk)
+        elapsed = time.perf_counter() - start
+        print(f"Data successfully written to {table_name}: {rows_written} rows in {elapsed:.1f} s "
+              f"({rows_written / max(elapsed, 1e-9):.0f} rows/s).")
+        return True
+    except Exception as e:
+        connection.rollback()
+        print(f"Error after {rows_written} rows: {e}")
+        return False
+    finally:
+        cursor.close()
+
+
+# Format a column as LOAD DATA text: \N for NULL, escaped tabs/newlines, MySQL DATETIME and 0/1 booleans
+def infile_column(series: pd.Series) -> pd.Series:
+    if pd.api.types.is_bool_dtype(series.dtype):
+        text = series.map({True: '1', False: '0'})
+    elif pd.api.types.is_datetime64_any_dtype(series.dtype):
+        text = series.dt.strftime('%Y-%m-%d %H:%M:%S')
+    elif pd.api.types.is_numeric_dtype(series.dtype):
+        text = series.astype(str)
+    else:
+        text = (series.astype(str)
+                .str.replace('\\', '\\\\', regex=False)
+                .str.replace('\t', '\\t', regex=False)
+                .str.replace('\n', '\\n', regex=False)
+                .str.replace('\r', '\\r', regex=False))
+    return text.where(series.notna(), '\\N')
+
+
+# True when every row was loaded
+def load_df_infile(df: pd.DataFrame, connection: pyodbc.Connection, table_name: str, chunk_size: int = 100000):
+    # Requires a connection opened with local_infile=True, see db.py
+    if df.empty:
+        return True
+    cursor = connection.cursor()
+    columns = ", ".join(df.columns)
+    fd, tmp_path = tempfile.mkstemp(suffix='.tsv')
+
+    start = time.perf_counter()
+    try:
+        # Write the DataFrame as tab separated text in MySQL's default LOAD DATA format
+        with os.fdopen(fd, 'w', encoding='utf8', newline='\n') as f:
+            for chunk_start in range(0, len(df), chunk_size):
+                chunk = df.iloc[chunk_start:chunk_start + chunk_size]
+                lines = infile_column(chunk[chunk.columns[0]])
+                for col_name in chunk.columns[1:]:
+                    lines = lines + '\t' + infile_column(chunk[col_name])
+                f.write('\n'.join(lines))
+                f.write('\n')
+
+        load_sql = f"""
+        LOAD DATA LOCAL INFILE '{tmp_path.replace(os.sep, '/')}' INTO TABLE {table_name}
+        CHARACTER SET utf8mb4
+        FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\'
+        LINES TERMINATED BY '\\n'
+        ({columns})
+        """
+        cursor.execute(load_sql)
         connection.commit()
-        print(f"Data successfully written to {table_name}.")
+        elapsed = time.perf_counter() - start
+        print(f"Data successfully loaded into {table_name}: {len(df)} rows in {elapsed:.1f} s "
+              f"({len(df) / max(elapsed, 1e-9):.0f} rows/s).")
+        return True
     except Exception as e:
         connection.rollback()
-        print(f"Error: {e}")
+        print(f"Error loading {table_name}: {e}")
+        return False
     finally:
         cursor.close()
+        os.remove(tmp_path)
+
+
+LOADERS = {'insert': write_df_to_sql,
+           'infile': load_df_infile}
+
+
+# Time each loader on the same DataFrame; the table is emptied before each run. Each run is recorded as stage
+# load_<loader> of the table. The connection needs local_infile=True for the infile loader.
+def benchmark_loaders(df: pd.DataFrame, connection: pyodbc.Connection, table_name: str):
+    timings = {}
+    for name, loader in LOADERS.items():
+        cursor = connection.cursor()
+        cursor.execute(f"DELETE FROM {table_name}")
+        connection.commit()
+        cursor.close()
+        with stage('data_integration', f'load_{name}', table_name) as metrics:
+            start = time.perf_counter()
+            loaded = loader(df, connection, table_name)
+            timings[name] = time.perf_counter() - start
+            metrics.add(rows=len(df) if loaded else 0)
+    for name, elapsed in timings.items():
+        print(f"{name:>8}: {elapsed:8.2f} s  {len(df) / max(elapsed, 1e-9):12.0f} rows/s")
+    return timings
 
 
 # Figuring out how to do this...
@@ -162,122 +271,272 @@ def test():
     conn_write.close()
 
 
-def main():
+FINANCE_SOURCES = {'users_data': 'users_data.csv',
+                   'cards_data': 'cards_data.csv',
+                   'mcc_codes': 'mcc_codes.json',
+                   'transactions_data': 'transactions_data.csv',
+                   'train_fraud_labels': 'train_fraud_labels.json'}
+
+# Cleaning specs for the finance tables, see cleaning.py
+FINANCE_SPECS = {
+    'users_data': {'currency': ['per_capita_income', 'yearly_income', 'total_debt'],
+                   'rename': {'id': 'client_id'},
+                   'dtypes': {'id': 'Int64',
+                              'current_age': 'Int64',
+                              'retirement_age': 'Int64',
+                              'birth_year': 'Int64',
+                              'birth_month': 'Int64',
+                              'latitude': 'Float64',
+                              'longitude': 'Float64',
+                              'per_capita_income': 'Float64',
+                              'yearly_income': 'Float64',
+                              'total_debt': 'Float64',
+                              'credit_score': 'Int64',
+                              'num_credit_cards': 'Int64'}},
+    'cards_data': {'currency': ['credit_limit'],
+                   'bool_maps': {'has_chip': {'YES': True, 'NO': False},
+                                 'card_on_dark_web': {'Yes': True, 'No': False}},
+                   'month_year': {'expires': ('expires_month', 'expires_year'),
+                                  'acct_open_date': ('acct_open_month', 'acct_open_year')},
+                   'rename': {'id': 'card_id'},
+                   'dtypes': {'id': 'Int64',
+                              'client_id': 'Int64',
+                              'num_cards_issued': 'Int64',
+                              'credit_limit': 'Float64',
+                              'year_pin_last_changed': 'Int64',
+                              'expires_month': 'Int64',
+                              'expires_year': 'Int64',
+                              'acct_open_month': 'Int64',
+                              'acct_open_year': 'Int64'}},
+    'mcc_codes': {'dtypes': {'mcc': 'Int64'}},
+    'transactions_data': {'datetimes': ['date'],
+                          'currency': ['amount'],
+                          'zero_pad': {'zip': 5},
+                          'rename': {'id': 'transaction_id'},
+                          'dtypes': {'id': 'Int64',
+                                     'client_id': 'Int64',
+                                     'card_id': 'Int64',
+                                     'amount': 'Float64',
+                                     'merchant_id': 'Int64',
+                                     'mcc': 'Int64'}},
+    'train_fraud_labels': {'bool_maps': {'isFraud': {'Yes': True, 'No': False}},
+                           'dtypes': {'transaction_id': 'Int64'}},
+}
+
+
+# JSON sources holding one object of key/value pairs, as (path to the object, column names of key and value).
+# They are streamed in chunks rather than loaded and transposed as a whole.
+JSON_SOURCES = {'mcc_codes': ((), ['mcc', 'name']),
+                'train_fraud_labels': (('target',), ['transaction_id', 'isFraud'])}
+
+# Primary key and secondary indexes ({name: columns}) of each table; foreign key columns get an index from MySQL
+PRIMARY_KEYS = {'users_data': ['client_id'],
+                'cards_data': ['card_id'],
+                'mcc_codes': ['mcc'],
+                'transactions_data': ['transaction_id'],
+                'train_fraud_labels': ['transaction_id']}
+INDEXES = {'transactions_data': {'idx_transactions_date': ['date']}}
+
+# Foreign keys as (table, column, referenced table, referenced column)
+FOREIGN_KEYS = [('cards_data', 'client_id', 'users_data', 'client_id'),
+                ('transactions_data', 'client_id', 'users_data', 'client_id'),
+                ('transactions_data', 'card_id', 'cards_data', 'card_id'),
+                ('transactions_data', 'mcc', 'mcc_codes', 'mcc'),
+                ('train_fraud_labels', 'transaction_id', 'transactions_data', 'transaction_id')]
+
+
+# Group tables into load levels so that every table only references tables in earlier levels
+def load_levels(tables, foreign_keys):
+    levels = []
+    loaded = set()
+    remaining = list(tables)
+    while remaining:
+        level = [table for table in remaining
+                 if all(ref_table in loaded or ref_table == table
+                        for fk_table, _, ref_table, _ in foreign_keys if fk_table == table)]
+        if not level:
+            raise ValueError(f"Circular foreign keys between tables {remaining}")
+        levels.append(level)
+        loaded.update(level)
+        remaining = [table for table in remaining if table not in loaded]
+    return levels
+
+
+# Cache key of a cleaned finance source: its content, its cleaning spec and the cleaning engine version
+def source_key(path, table_name, engine='c'):
+    return ColumnarCache.key(file_hash(path + FINANCE_SOURCES[table_name]), FINANCE_SPECS[table_name],
+                             CLEANING_VERSION, engine)
+
+
+# Read and adjust one of the finance sources (top-level so it can run in a worker process).
+# The extract stage covers parsing and cleaning, which read_csv_spec does in one pass.
+def read_table(path, table_name, engine='c', cache=None):
+    with stage('data_integration', 'extract', table_name) as metrics:
+        if cache is not None:
+            df = cache.get_or_compute(source_key(path, table_name, engine),
+                                      lambda: parse_table(path, table_name, engine))
+        else:
+            df = parse_table(path, table_name, engine)
+        metrics.add(rows=len(df), nbytes=os.path.getsize(path + FINANCE_SOURCES[table_name]))
+        metrics.extra['use_cache'] = cache is not None
+    return df
+
+
+def parse_table(path, table_name, engine='c'):
+    if table_name in JSON_SOURCES:
+        json_path, columns = JSON_SOURCES[table_name]
+        chunks = read_object_chunks(path + FINANCE_SOURCES[table_name], columns, json_path)
+        return pd.concat([clean_df(chunk, FINANCE_SPECS[table_name]) for chunk in chunks], ignore_index=True)
+    return read_csv_spec(path + FINANCE_SOURCES[table_name], FINANCE_SPECS[table_name], engine=engine)
+
+
+# Stream the cleaned transactions_data chunks, through the cache when one is given. The chunk size is part of
+# the cache key, as the cache hands back the chunks as they were written.
+def read_transactions(path, chunk_size, cache=None):
+    def read_chunks():
+        return read_csv_spec(path + FINANCE_SOURCES['transactions_data'], FINANCE_SPECS['transactions_data'],
+                             chunksize=chunk_size)
+    if cache is None:
+        return read_chunks()
+    return cache.chunks(ColumnarCache.key(source_key(path, 'transactions_data'), chunk_size), read_chunks)
+
+
+# First chunk of transactions_data, read up front to create the table; the rest is read during its load stage
+def first_chunk(transactions_reader):
+    with stage('data_integration', 'extract', 'transactions_data') as metrics:
+        chunk = next(transactions_reader)
+        metrics.add(rows=len(chunk))
+    return chunk
+
+
+# Columns of a table that take part in its primary key or a foreign key. Compact mode leaves their dtype alone,
+# so that both sides of a foreign key keep the same MySQL type.
+def key_columns(table_name):
+    return (set(PRIMARY_KEYS[table_name])
+            | {column for table, column, _, _ in FOREIGN_KEYS if table == table_name}
+            | {ref_column for _, _, ref_table, ref_column in FOREIGN_KEYS if ref_table == table_name})
+
+
+# Schema of a finance table, inferred from its frame (the first chunk for transactions_data)
+def finance_schema(table_name, df, compact=False):
+    foreign_keys = [(column, ref_table, ref_column)
+                    for table, column, ref_table, ref_column in FOREIGN_KEYS if table == table_name]
+    return TableSchema.from_df(table_name, df, PRIMARY_KEYS[table_name], INDEXES.get(table_name), foreign_keys,
+                               compact, chunked=(table_name == 'transactions_data'))
+
+
+# Write a table, given as a sequence of DataFrame chunks, over a connection from the shared pool.
+# Time spent reading lazily parsed chunks (transactions_data) is recorded apart as read_seconds.
+# With a schema (table created from the first chunk in this run) ENUM columns are widened to fit each chunk.
+# Stops at the first chunk the loader fails on, as the rows after it would leave holes in the table;
+# returns False then.
+def write_table_chunks(chunks, write_db, table_name, loader, schema=None):
+    with stage('data_integration', 'load', table_name) as metrics:
+        metrics.extra['loader'] = loader
+        with get_pool(write_db, local_infile=(loader == 'infile')).connection() as connection:
+            for chunk in metrics.timed(chunks):
+                if schema is not None:
+                    widen_table(chunk, connection, schema)
+                if not LOADERS[loader](chunk, connection, table_name):
+                    print(f"Stopped loading {table_name} after {metrics.rows} rows.")
+                    return False
+                metrics.add(rows=len(chunk), nbytes=int(chunk.memory_usage(index=False).sum()))
+    return True
+
+
+# compact=True downcasts the frames (see compact_df) and creates the tables with matching compact MySQL types.
+# defer_constraints=True creates the tables bare and adds their keys, indexes and foreign keys after the load.
+# Returns False when a table failed to load; the levels after it and the deferred constraints are skipped then.
+def main(loader='insert', chunk_size=500000, engine='c', workers=1, use_cache=True, compact=False,
+         defer_constraints=False, path='./data/finance/'):
     # test()
 
     # Using https://www.kaggle.com/datasets/computingvictor/transactions-fraud-datasets/
-    path = './data/finance/'
-
-    # Read and adjust users_data
-    users_data = pd.read_csv(path + 'users_data.csv', dtype='str')
-    users_data[['per_capita_income', 'yearly_income', 'total_debt']] = (
-        users_data[['per_capita_income', 'yearly_income', 'total_debt']].replace(r'\$', '', regex=True))
-    users_data = users_data.rename(columns={'id':'client_id'})
-    users_data = users_data.astype({'client_id': 'Int64',
-                                    'current_age': 'Int64',
-                                    'retirement_age': 'Int64',
-                                    'birth_year': 'Int64',
-                                    'birth_month': 'Int64',
-                                    'latitude': 'Float64',
-                                    'longitude': 'Float64',
-                                    'per_capita_income': 'Float64',
-                                    'yearly_income': 'Float64',
-                                    'total_debt': 'Float64',
-                                    'credit_score': 'Int64',
-                                    'num_credit_cards': 'Int64'})
-
-    # Read and adjust cards_data
-    cards_data = pd.read_csv(path + 'cards_data.csv', dtype='str')
-    cards_data[['credit_limit']] = cards_data[['credit_limit']].replace(r'\$', '', regex=True)
-    cards_data['has_chip'] = cards_data['has_chip'].map({'YES': True, 'NO': False}).astype(bool)
-    cards_data['card_on_dark_web'] = cards_data['card_on_dark_web'].map({'Yes': True, 'No': False}).astype(bool)
-    cards_data['expires_month'] = cards_data['expires'].str[:2]
-    cards_data['expires_year'] = cards_data['expires'].str[3:]
-    cards_data = cards_data.drop('expires', axis=1)
-    cards_data['acct_open_month'] = cards_data['acct_open_date'].str[:2]
-    cards_data['acct_open_year'] = cards_data['acct_open_date'].str[3:]
-    cards_data = cards_data.drop('acct_open_date', axis=1)
-    cards_data = cards_data.rename(columns={'id':'card_id'})
-    cards_data = cards_data.astype({'card_id': 'Int64',
-                                    'client_id': 'Int64',
-                                    'num_cards_issued': 'Int64',
-                                    'credit_limit': 'Float64',
-                                    'year_pin_last_changed': 'Int64',
-                                    'expires_month': 'Int64',
-                                    'expires_year': 'Int64',
-                                    'acct_open_month': 'Int64',
-                                    'acct_open_year': 'Int64'})
-
-    # Read and adjust mcc_codes
-    with open(path + 'mcc_codes.json') as f:
-        mcc_codes_j = json.load(f)
-    mcc_codes = pd.json_normalize(mcc_codes_j).transpose().reset_index()
-    mcc_codes.columns = ['mcc', 'name']
-    mcc_codes = mcc_codes.astype({'mcc': 'Int64'})
-
-    # Read and adjust transactions_data
-    transactions_data = pd.read_csv(path + 'transactions_data.csv', dtype='str')
-    transactions_data['date'] = pd.to_datetime(transactions_data['date'])
-    transactions_data[['amount']] = transactions_data[['amount']].replace(r'\$', '', regex=True)
-    transactions_data['zip'] = transactions_data['zip'].str.replace('.0','').str.zfill(5)
-    transactions_data = transactions_data.rename(columns={'id':'transaction_id'})
-    transactions_data = transactions_data.astype({'transaction_id': 'Int64',
-                                                  'client_id': 'Int64',
-                                                  'card_id': 'Int64',
-                                                  'amount': 'Float64',
-                                                  'merchant_id': 'Int64',
-                                                  'mcc': 'Int64'})
-
-    # Read and adjust train_fraud_labels
-    with open(path + 'train_fraud_labels.json') as f:
-        train_fraud_labels = json.load(f)
-    train_fraud_labels = pd.json_normalize(train_fraud_labels['target']).transpose().reset_index()
-    train_fraud_labels.columns = ['transaction_id', 'isFraud']
-    train_fraud_labels['isFraud'] = train_fraud_labels['isFraud'].map({'Yes': True, 'No': False}).astype(bool)
-    train_fraud_labels = train_fraud_labels.astype({'transaction_id': 'Int64'})
-
-    # Initialize connection for writing to database
+    tables = ['users_data', 'cards_data', 'mcc_codes', 'transactions_data', 'train_fraud_labels']
+    parsed_tables = [table for table in tables if table != 'transactions_data']
+
+    # Read and adjust the sources, or read them back from the columnar cache when they are unchanged.
+    # With several workers they are parsed in parallel processes.
+    # transactions_data is streamed in chunks in this process; the first chunk is used to create the table.
+    cache = ColumnarCache() if use_cache else None
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {table: pool.submit(read_table, path, table, engine, cache) for table in parsed_tables}
+            transactions_reader = read_transactions(path, chunk_size, cache)
+            frames = {'transactions_data': first_chunk(transactions_reader)}
+            frames.update({table: future.result() for table, future in futures.items()})
+    else:
+        frames = {table: read_table(path, table, engine, cache) for table in parsed_tables}
+        transactions_reader = read_transactions(path, chunk_size, cache)
+        frames['transactions_data'] = first_chunk(transactions_reader)
+    transactions_rest = transactions_reader
+    if compact:
+        frames = {table: compact_df(frame, keep=key_columns(table)) for table, frame in frames.items()}
+        # Later chunks keep the category columns of the first one, whatever their own cardinality
+        first = frames['transactions_data']
+        keep = key_columns('transactions_data')
+        category_columns = [col for col in first.columns if isinstance(first[col].dtype, pd.CategoricalDtype)]
+        transactions_rest = (compact_df(chunk, keep=keep, category_columns=category_columns)
+                             for chunk in transactions_reader)
+
+    # Create the tables on a connection from the shared pool. Unless the constraints are deferred, add the
+    # keys, indexes and foreign keys the tables do not have yet before loading.
     write_db = 'datamerge'
-    conn_write = odbc_init(write_db)
-
-    # Create tables
-    create_table_from_df(users_data, conn_write, 'users_data')
-    create_table_from_df(cards_data, conn_write, 'cards_data')
-    create_table_from_df(mcc_codes, conn_write, 'mcc_codes')
-    create_table_from_df(transactions_data, conn_write, 'transactions_data')
-    create_table_from_df(train_fraud_labels, conn_write, 'train_fraud_labels')
-
-    # Add foreign keys if not already added
-    conn_is = odbc_init('INFORMATION_SCHEMA')
-    all_foreign_keys = df_from_sql(conn_is,
-        f"SELECT CONSTRAINT_NAME FROM KEY_COLUMN_USAGE WHERE REFERENCED_TABLE_SCHEMA = '{write_db}'")
-    all_foreign_keys = all_foreign_keys['CONSTRAINT_NAME'].tolist()
-    conn_is.close()
-
-    add_foreign_key(conn_write,'cards_data','client_id',
-                    'users_data', 'client_id', all_foreign_keys)
-    add_foreign_key(conn_write,'transactions_data','client_id',
-                    'users_data', 'client_id', all_foreign_keys)
-    add_foreign_key(conn_write,'transactions_data','card_id',
-                    'cards_data', 'card_id', all_foreign_keys)
-    add_foreign_key(conn_write,'transactions_data','mcc',
-                    'mcc_codes', 'mcc', all_foreign_keys)
-    add_foreign_key(conn_write,'train_fraud_labels','transaction_id',
-                    'transactions_data', 'transaction_id', all_foreign_keys)
-
-    # Write data to database
-    write_df_to_sql(users_data, conn_write, 'users_data')
-    write_df_to_sql(cards_data, conn_write, 'cards_data')
-    write_df_to_sql(mcc_codes, conn_write, 'mcc_codes')
-    write_df_to_sql(transactions_data, conn_write, 'transactions_data')
-    write_df_to_sql(train_fraud_labels, conn_write, 'train_fraud_labels')
-
-    # Close connection
-    conn_write.close()
+    schemas = {table: finance_schema(table, frames[table], compact) for table in tables}
+    with get_pool(write_db).connection() as conn_write:
+        created = {}
+        for table in tables:
+            with stage('data_integration', 'ddl', table):
+                created[table] = create_table(conn_write, schemas[table], bare=defer_constraints)
+        if not defer_constraints:
+            for table in tables:
+                with stage('data_integration', 'constraints', table):
+                    add_constraints(conn_write, schemas[table])
+
+    # Write data to database level by level; tables within a level do not reference each other.
+    # In compact mode the ENUM columns of transactions_data are widened to fit its later chunks when it was
+    # created in this run.
+    chunks = {table: [frames[table]] for table in parsed_tables}
+    chunks['transactions_data'] = chain([frames['transactions_data']], transactions_rest)
+    widened = {'transactions_data': schemas['transactions_data']} if compact and created['transactions_data'] else {}
+    levels = load_levels(tables, FOREIGN_KEYS)
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as writers:
+        for level in levels:
+            print(f"Writing {', '.join(level)}...")
+            futures = {table: writers.submit(write_table_chunks, chunks[table], write_db, table, loader,
+                                             widened.get(table))
+                       for table in level}
+            failed = [table for table, future in futures.items() if not future.result()]
+            if failed:
+                break
+    if failed:
+        print(f"Loading {', '.join(failed)} failed; the tables referencing them were not loaded.")
+        transactions_reader.close()
+        close_pools()
+        return False
+
+    # Build the deferred keys level by level, so that referenced keys exist before the foreign keys using them
+    if defer_constraints:
+        with get_pool(write_db).connection() as conn_write:
+            for level in levels:
+                for table in level:
+                    with stage('data_integration', 'constraints', table):
+                        add_constraints(conn_write, schemas[table])
+    transactions_reader.close()
+
+    # Close connections
+    close_pools()
+    return True
 
 
 if __name__ == '__main__':
-    main()
+    try:
+        if not main():
+            sys.exit(1)
+    finally:
+        # Also on errors, so the connections are closed and the pool statistics printed
+        close_pools()
 
 # ***  dmiapi.govcloud.dk  ***
 # dmi_country = rest_query('https://dmigw.govcloud.dk/v2/climateData/bulk/countryValue/',
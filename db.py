@@ -0,0 +1,143 @@
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+import pyodbc
+
+# Connection settings come from the environment; the defaults match the local development server
+DB_DRIVER = os.environ.get('DB_DRIVER', 'MySQL ODBC 8.0 ANSI Driver')
+DB_SERVER = os.environ.get('DB_SERVER', 'localhost')
+DB_USER = os.environ.get('DB_USER', 'brk')
+DB_PASSWORD = os.environ.get('DB_PASSWORD', '12345678')
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '4'))
+
+
+def odbc_init(db, local_infile=False):
+    # Specifying the ODBC driver, server name, database, etc. from the environment
+    cnxn = pyodbc.connect('DRIVER={' + DB_DRIVER + '};SERVER=' + DB_SERVER + ';DATABASE=' + db
+                          + ';UID=' + DB_USER + ';PWD=' + DB_PASSWORD + ';Charset=utf8'
+                          + (';ENABLE_LOCAL_INFILE=1' if local_infile else ''))
+
+    # Encoding and decoding
+    cnxn.setdecoding(pyodbc.SQL_CHAR, encoding='utf8')
+    cnxn.setdecoding(pyodbc.SQL_WCHAR, encoding='utf8')
+    cnxn.setencoding(encoding='utf8')
+    return cnxn
+
+
+# Opens the connections of the pools; replaced by set_connection_factory, e.g. with a stand-in for benchmarks
+_connection_factory = odbc_init
+
+
+def set_connection_factory(factory):
+    global _connection_factory
+    close_pools()
+    _connection_factory = factory or odbc_init
+
+
+# Thread-safe pool of connections to one database. Connections are opened lazily on first checkout,
+# up to max_size; further checkouts wait for a connection to be returned. A broken connection, or one that
+# failed to open, hands its slot back as None in the idle queue; whoever gets it opens a replacement, so
+# waiting checkouts are woken up as well.
+class ConnectionPool:
+    def __init__(self, db, max_size=DB_POOL_SIZE, local_infile=False):
+        self.db = db
+        self.max_size = max_size
+        self.local_infile = local_infile
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.checkouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def checkout(self):
+        start = time.perf_counter()
+        try:
+            cnxn = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                open_new = self.opened < self.max_size
+                if open_new:
+                    self.opened += 1
+            cnxn = None if open_new else self.idle.get()
+        if cnxn is None:
+            try:
+                cnxn = _connection_factory(self.db, self.local_infile)
+            except Exception:
+                self.idle.put(None)
+                raise
+        waited = time.perf_counter() - start
+        with self.lock:
+            self.checkouts += 1
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+        return cnxn
+
+    # Return a connection; uncommitted work is rolled back so the next user starts clean
+    def checkin(self, cnxn):
+        try:
+            cnxn.rollback()
+            self.idle.put(cnxn)
+        except pyodbc.Error:
+            # Broken connection: drop it and hand its slot to the next checkout
+            self.idle.put(None)
+
+    @contextmanager
+    def connection(self):
+        cnxn = self.checkout()
+        try:
+            yield cnxn
+        finally:
+            self.checkin(cnxn)
+
+    def stats(self):
+        with self.lock:
+            return {'db': self.db,
+                    'opened': self.opened,
+                    'checkouts': self.checkouts,
+                    'wait_time': self.wait_time,
+                    'max_wait_time': self.max_wait_time}
+
+    def close(self):
+        while True:
+            try:
+                cnxn = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            if cnxn is not None:
+                cnxn.close()
+            with self.lock:
+                self.opened -= 1
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+# The shared pool for a database, created on first use and reused by every stage of the run
+def get_pool(db, local_infile=False, max_size=DB_POOL_SIZE):
+    with _pools_lock:
+        key = (db, local_infile)
+        if key not in _pools:
+            _pools[key] = ConnectionPool(db, max_size, local_infile)
+        return _pools[key]
+
+
+def pool_stats():
+    with _pools_lock:
+        return [pool.stats() for pool in _pools.values()]
+
+
+# Print the checkout metrics of every pool and close their connections
+def close_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        stats = pool.stats()
+        print(f"Connection pool '{stats['db']}': {stats['opened']} connections, {stats['checkouts']} checkouts, "
+              f"{stats['wait_time']:.3f} s total wait, {stats['max_wait_time']:.3f} s max wait.")
+        pool.close()
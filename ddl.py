@@ -0,0 +1,240 @@
+import re
+import time
+
+import pandas as pd
+
+
+# PARTITION BY RANGE clause with one partition per year from first_year to last_year and one for later rows.
+# MySQL requires the column to be part of every unique key of the table.
+def year_partitions_sql(column, first_year, last_year):
+    partitions = [f"PARTITION p{year} VALUES LESS THAN ({year + 1})" for year in range(first_year, last_year + 1)]
+    partitions.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+    return f"PARTITION BY RANGE (YEAR(`{column}`)) (\n            " + ",\n            ".join(partitions) + "\n        )"
+
+
+# partition_years from a --partition-years FIRST-LAST command line argument, e.g. --partition-years 2015-2030;
+# None without one
+def partition_years_arg(args):
+    if '--partition-years' not in args:
+        return None
+    first, last = args[args.index('--partition-years') + 1].split('-')
+    return int(first), int(last)
+
+
+# Time the same query as a full table scan (USE INDEX () disables all indexes) and with the indexes
+def benchmark_index(connection, table_name, where_sql, params, repeats=3):
+    cursor = connection.cursor()
+    timings = {}
+    for label, hint in [('full scan', 'USE INDEX ()'), ('index', '')]:
+        query = f"SELECT * FROM `{table_name}` {hint} WHERE {where_sql}"
+        best = None
+        for _ in range(repeats):
+            start = time.perf_counter()
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[label] = best
+        print(f"{label:>9}: {best * 1000:10.1f} ms for {len(rows)} rows")
+    cursor.close()
+    return timings
+
+
+# Integer SQL types from narrowest to widest; compact mode maps Int8/Int16 columns to the first two
+INT_SQL_TYPES = ['TINYINT', 'SMALLINT', 'INT', 'BIGINT']
+MAX_ENUM_VALUES = 65535
+# Longest text kept in a VARCHAR; longer text goes to TEXT
+MAX_VARCHAR = 255
+
+
+def enum_sql(values):
+    return "ENUM(" + ", ".join("'" + str(value).replace("'", "''") + "'" for value in values) + ")"
+
+
+def enum_values(sql_type):
+    return [value.replace("''", "'") for value in re.findall(r"'((?:[^']|'')*)'", sql_type)]
+
+
+# Width of a VARCHAR holding text of up to length characters, with room to grow: twice the length rounded up
+# to a power of two, at least 8
+def varchar_width(length):
+    return min(MAX_VARCHAR, max(8, 1 << (2 * int(length) - 1).bit_length()))
+
+
+# Longest text of a column's values once written as text
+def max_text_length(values: pd.Series):
+    values = values.dropna()
+    if not len(values):
+        return 0
+    try:
+        lengths = values.str.len()
+    except AttributeError:
+        lengths = None
+    if lengths is None or lengths.isna().any():
+        lengths = values.astype(str).str.len()
+    return int(lengths.max())
+
+
+def text_sql(length):
+    return f"VARCHAR({varchar_width(length)})" if length <= MAX_VARCHAR else "TEXT"
+
+
+# Map a pandas column to a MySQL type; text columns get a VARCHAR wide enough for their longest value.
+# In compact mode category columns become ENUMs of their categories, Int8/Int16 columns TINYINT/SMALLINT and
+# datetime columns without a time of day DATE.
+def sql_type(series: pd.Series, compact: bool = False) -> str:
+    dtype = series.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        categories = series.cat.categories
+        if compact and len(categories):
+            return enum_sql(categories)
+        return text_sql(max_text_length(categories.to_series()))
+    if pd.api.types.is_bool_dtype(dtype):
+        return "BOOL"
+    if pd.api.types.is_integer_dtype(dtype):
+        if compact and dtype.itemsize <= 2:
+            return INT_SQL_TYPES[dtype.itemsize - 1]
+        values = series.dropna()
+        if len(values) and (values.min() < -2 ** 31 or values.max() >= 2 ** 31):
+            return "BIGINT"
+        return "INT"
+    if pd.api.types.is_float_dtype(dtype):
+        return "DOUBLE"
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        times = series.dropna()
+        if compact and len(times) and (times == times.dt.normalize()).all():
+            return "DATE"
+        return "DATETIME"
+    return text_sql(max_text_length(series))
+
+
+# Type of a column of a table loaded in chunks, given the type inferred from the first chunk: wide enough for
+# the later chunks without knowing them. Text gets the widest VARCHAR, integers at least INT (BIGINT when the
+# first chunk comes within a factor of two of the INT range) and dates DATETIME. ENUMs are widened per chunk.
+def chunked_sql_type(series: pd.Series, col_type: str) -> str:
+    if col_type.startswith('VARCHAR('):
+        return f"VARCHAR({MAX_VARCHAR})"
+    if col_type in INT_SQL_TYPES:
+        values = series.dropna()
+        if col_type == 'BIGINT' or (len(values) and (values.min() < -2 ** 30 or values.max() >= 2 ** 30)):
+            return 'BIGINT'
+        return 'INT'
+    if col_type == 'DATE':
+        return 'DATETIME'
+    return col_type
+
+
+# ENUM holding the values of both ENUMs, used when a later chunk has categories the first chunk did not;
+# a VARCHAR or TEXT once there are more values than an ENUM holds
+def wider_enum_sql(old: str, new: str) -> str:
+    values = enum_values(old)
+    values += [value for value in enum_values(new) if value not in values]
+    if len(values) <= MAX_ENUM_VALUES:
+        return enum_sql(values)
+    return text_sql(max(len(value) for value in values))
+
+
+# Schema of one table: column types and nullability inferred from the data, plus explicit primary key,
+# secondary indexes ({name: [columns]}) and foreign keys ([(column, referenced table, referenced column)]).
+# A table can be created bare, without any of its keys, and get them all in one ALTER TABLE after the load;
+# building the indexes once over the loaded rows is much faster than checking them for every inserted row.
+class TableSchema:
+    def __init__(self, name, columns, not_null=(), primary_key=(), indexes=None, foreign_keys=()):
+        self.name = name
+        self.columns = dict(columns)
+        self.not_null = set(not_null) | set(primary_key)
+        self.primary_key = list(primary_key)
+        self.indexes = dict(indexes or {})
+        self.foreign_keys = list(foreign_keys)
+
+    # Infer the schema from a DataFrame. For a table loaded in chunks it is inferred from the first chunk; pass
+    # chunked=True there, which leaves the columns nullable and sizes them for the later chunks (see
+    # chunked_sql_type), as changing either later rebuilds the table in the middle of the load.
+    @classmethod
+    def from_df(cls, name, df, primary_key=(), indexes=None, foreign_keys=(), compact=False, chunked=False):
+        columns = {col: sql_type(df[col], compact) for col in df.columns}
+        if chunked:
+            columns = {col: chunked_sql_type(df[col], col_type) for col, col_type in columns.items()}
+        not_null = [col for col in df.columns if not chunked and len(df) and df[col].notna().all()]
+        return cls(name, columns, not_null, primary_key, indexes, foreign_keys)
+
+    def column_sql(self, col):
+        return f"`{col}` {self.columns[col]}" + (" NOT NULL" if col in self.not_null else "")
+
+    def foreign_key_name(self, column):
+        return f"fk_{self.name}_{column}"
+
+    # Key, index and (with foreign_keys) foreign key clauses, leaving out those whose name is in existing
+    def constraint_clauses(self, existing=(), foreign_keys=True):
+        clauses = []
+        if self.primary_key and 'PRIMARY' not in existing:
+            clauses.append("PRIMARY KEY (" + ", ".join(f"`{col}`" for col in self.primary_key) + ")")
+        for index_name, columns in self.indexes.items():
+            if index_name not in existing:
+                clauses.append(f"KEY `{index_name}` (" + ", ".join(f"`{col}`" for col in columns) + ")")
+        for column, ref_table, ref_column in self.foreign_keys if foreign_keys else []:
+            if self.foreign_key_name(column) not in existing:
+                clauses.append(f"CONSTRAINT `{self.foreign_key_name(column)}` FOREIGN KEY (`{column}`) "
+                               f"REFERENCES `{ref_table}`(`{ref_column}`)")
+        return clauses
+
+    # CREATE TABLE statement with the primary key and indexes, or none of them with bare=True.
+    # Foreign keys are always added afterwards (constraints_sql), once the referenced tables exist.
+    def create_sql(self, bare=False):
+        definitions = [self.column_sql(col) for col in self.columns]
+        if not bare:
+            definitions += self.constraint_clauses(foreign_keys=False)
+        return f"CREATE TABLE IF NOT EXISTS `{self.name}` (\n    " + ",\n    ".join(definitions) + "\n)"
+
+    # One ALTER TABLE adding every key, index and foreign key not in existing; None if there is nothing to add
+    def constraints_sql(self, existing=()):
+        clauses = self.constraint_clauses(existing)
+        if not clauses:
+            return None
+        return f"ALTER TABLE `{self.name}`\n    " + ",\n    ".join("ADD " + clause for clause in clauses)
+
+    # One ALTER TABLE appending the category values of a later chunk to the ENUM columns (compact mode), which
+    # only changes the table metadata. The other columns of a chunked table are created wide enough up front
+    # (see chunked_sql_type), so they are not checked. Updates the schema; None if the chunk fits.
+    def widen_sql(self, df):
+        changed = []
+        for col in df.columns:
+            values = df[col]
+            if not self.columns[col].startswith('ENUM(') or not isinstance(values.dtype, pd.CategoricalDtype):
+                continue
+            if not len(values.cat.categories):
+                continue
+            col_type = wider_enum_sql(self.columns[col], enum_sql(values.cat.categories))
+            if col_type != self.columns[col]:
+                self.columns[col] = col_type
+                changed.append(col)
+        if not changed:
+            return None
+        return f"ALTER TABLE `{self.name}`\n    " + ",\n    ".join("MODIFY " + self.column_sql(col) for col in changed)
+
+
+# Names of the indexes (PRIMARY for the primary key) and foreign keys a table already has
+def existing_constraints(connection, table_name):
+    cursor = connection.cursor()
+    cursor.execute("SELECT INDEX_NAME FROM INFORMATION_SCHEMA.STATISTICS "
+                   "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = ?", table_name)
+    names = {row[0] for row in cursor.fetchall()}
+    cursor.execute("SELECT CONSTRAINT_NAME FROM INFORMATION_SCHEMA.TABLE_CONSTRAINTS "
+                   "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = ? AND CONSTRAINT_TYPE = 'FOREIGN KEY'",
+                   table_name)
+    names |= {row[0] for row in cursor.fetchall()}
+    cursor.close()
+    return names
+
+
+# True when the table exists but has no primary key, e.g. because it was created before the key was introduced
+def missing_primary_key(cursor, table_name):
+    cursor.execute("SELECT COUNT(*) FROM INFORMATION_SCHEMA.TABLES "
+                   "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = ?", table_name)
+    row = cursor.fetchone()
+    if row is None or row[0] == 0:
+        return False
+    cursor.execute("SELECT COUNT(*) FROM INFORMATION_SCHEMA.STATISTICS "
+                   "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = ? AND INDEX_NAME = 'PRIMARY'", table_name)
+    row = cursor.fetchone()
+    return row is None or row[0] == 0
@@ -0,0 +1,60 @@
+import numpy as np
+
+
+# Keep the minimum and maximum of each of max_points / 2 equal-sized index buckets, so peaks survive decimation
+def minmax_decimate(x, y, max_points):
+    x = np.asarray(x)
+    y = np.asarray(y, dtype='float64')
+    n_buckets = max_points // 2
+    if len(y) <= max_points or n_buckets < 1:
+        return x, y
+    bucket_size = -(-len(y) // n_buckets)
+    padded = np.full(n_buckets * bucket_size, np.nan)
+    padded[:len(y)] = y
+    buckets = padded.reshape(n_buckets, bucket_size)
+    offsets = np.arange(n_buckets) * bucket_size
+    lows = offsets + np.argmin(np.where(np.isnan(buckets), np.inf, buckets), axis=1)
+    highs = offsets + np.argmax(np.where(np.isnan(buckets), -np.inf, buckets), axis=1)
+    keep = np.unique(np.concatenate([lows, highs]))
+    keep = keep[keep < len(y)]
+    return x[keep], y[keep]
+
+
+# Largest-Triangle-Three-Buckets: keep the first and last point and, per bucket, the point forming the largest
+# triangle with the previously kept point and the mean of the next bucket. Missing values are dropped first.
+def lttb(x, y, max_points):
+    x = np.asarray(x)
+    y = np.asarray(y, dtype='float64')
+    present = ~np.isnan(y)
+    x, y = x[present], y[present]
+    if len(y) <= max_points or max_points < 3:
+        return x, y
+    # Work on x as numbers; datetime64 values are used through their integer representation
+    if np.issubdtype(x.dtype, np.datetime64):
+        xs = x.astype('datetime64[s]').astype('int64').astype('float64')
+    else:
+        xs = x.astype('float64')
+    edges = np.linspace(1, len(y) - 1, max_points - 1).astype('int64')
+    keep = np.empty(max_points, dtype='int64')
+    keep[0] = 0
+    keep[-1] = len(y) - 1
+    previous = 0
+    for i in range(max_points - 2):
+        start, stop = edges[i], edges[i + 1]
+        next_stop = edges[i + 2] if i + 2 < len(edges) else len(y)
+        next_start = stop if stop < next_stop else next_stop - 1
+        mean_x = xs[next_start:next_stop].mean()
+        mean_y = y[next_start:next_stop].mean()
+        areas = np.abs((xs[previous] - mean_x) * (y[start:stop] - y[previous])
+                       - (xs[previous] - xs[start:stop]) * (mean_y - y[previous]))
+        previous = start + int(np.argmax(areas))
+        keep[i + 1] = previous
+    return x[keep], y[keep]
+
+
+def downsample(x, y, max_points, method='minmax'):
+    if method == 'minmax':
+        return minmax_decimate(x, y, max_points)
+    if method == 'lttb':
+        return lttb(x, y, max_points)
+    raise ValueError(f"Unknown downsampling method: {method}")
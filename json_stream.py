@@ -0,0 +1,137 @@
+import json
+
+import pandas as pd
+
+_decoder = json.JSONDecoder()
+
+
+# Text of a file read in blocks; pos is the position of the next unread character in buffer
+class _BlockReader:
+    def __init__(self, file, block_size):
+        self.file = file
+        self.block_size = block_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    # Append the next block, dropping what has been consumed; False at the end of the file
+    def fill(self):
+        block = self.file.read(self.block_size)
+        if not block:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + block
+        self.pos = 0
+        return True
+
+    # Next non-whitespace character without consuming it; '' at the end of the file
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self.fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+    # Consume one of the given characters and return it
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f"Expected one of {chars!r} but found {char!r}")
+        self.pos += 1
+        return char
+
+    # Decode the next complete value, reading more blocks until it is complete. A value ending exactly at the
+    # end of the buffer may be a truncated number, so it is only accepted at the end of the file.
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    # Decode the members from the current position up to the last comma in the buffer that ends a member, as
+    # one dict; None when the buffer holds no complete member. A comma inside a string makes the decode fail,
+    # in which case the comma before it is tried.
+    def members(self):
+        cut = self.buffer.rfind(',', self.pos)
+        while cut != -1:
+            try:
+                members = json.loads('{' + self.buffer[self.pos:cut] + '}')
+            except ValueError:
+                cut = self.buffer.rfind(',', self.pos, cut)
+                continue
+            self.pos = cut + 1
+            return members
+        return None
+
+    # Decode the rest of the object, whose closing brace is in the buffer; None if it is not
+    def last_members(self):
+        try:
+            members, end = _decoder.raw_decode('{' + self.buffer[self.pos:])
+        except ValueError:
+            return None
+        self.pos += end - 1
+        return members
+
+
+# Stream the members of the JSON object found at path (keys from the top-level object; empty for the top-level
+# object itself) as lists of keys and values, one pair of lists per block read. Only one block of text and the
+# members decoded from it are held in memory at a time. As with json.load, a repeated key keeps its last value
+# within a block.
+def iter_object_blocks(file_path, path=(), block_size=1 << 20):
+    with open(file_path, encoding='utf8') as file:
+        reader = _BlockReader(file, block_size)
+        reader.expect('{')
+        for key in path:
+            while True:
+                if reader.peek() == '}':
+                    raise KeyError(key)
+                name = reader.value()
+                reader.expect(':')
+                if name == key:
+                    reader.expect('{')
+                    break
+                reader.value()
+                if reader.expect(',}') == '}':
+                    raise KeyError(key)
+
+        while True:
+            # Most blocks end inside the object: decode up to the last member separator. Otherwise the closing
+            # brace may be in this block.
+            members = reader.members()
+            closed = False
+            if members is None or reader.eof:
+                last = reader.last_members()
+                if last is not None:
+                    members = {**(members or {}), **last}
+                    closed = True
+            if members:
+                yield list(members), list(members.values())
+            if closed:
+                return
+            if not reader.fill() and members is None:
+                raise ValueError(f"Malformed JSON near {reader.buffer[reader.pos:reader.pos + 50]!r}")
+
+
+# The members of the object at path as DataFrames of about chunk_size rows with the given two column names.
+# At least one, possibly empty, DataFrame is yielded.
+def read_object_chunks(file_path, columns, path=(), chunk_size=1000000, block_size=1 << 20):
+    keys = []
+    values = []
+    emitted = False
+    for block_keys, block_values in iter_object_blocks(file_path, path, block_size):
+        keys += block_keys
+        values += block_values
+        if len(keys) >= chunk_size:
+            yield pd.DataFrame({columns[0]: keys, columns[1]: values})
+            keys = []
+            values = []
+            emitted = True
+    if keys or not emitted:
+        yield pd.DataFrame({columns[0]: keys, columns[1]: values})
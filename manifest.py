@@ -0,0 +1,79 @@
+import hashlib
+import os
+
+
+# Create the table recording which source files have been ingested into which table
+def create_manifest_table(cursor):
+    query = """
+        CREATE TABLE IF NOT EXISTS `ingest_manifest` (
+            `table_name` VARCHAR(64) NOT NULL,
+            `file_path` VARCHAR(512) NOT NULL,
+            `size` BIGINT,
+            `mtime` DOUBLE,
+            `content_hash` CHAR(64),
+            `loaded_at` DATETIME,
+            PRIMARY KEY (`table_name`, `file_path`)
+        );
+    """
+    cursor.execute(query)
+
+
+# SHA-256 of a file, read in blocks
+def file_hash(file_path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# (file_path, size, mtime, content_hash) of a file
+def file_info(file_path):
+    stat = os.stat(file_path)
+    return file_path, stat.st_size, stat.st_mtime, file_hash(file_path)
+
+
+# Return (file_path, size, mtime, content_hash) for each file that is new or changed since it was last ingested.
+# Files with unchanged size and mtime are skipped without being hashed.
+def changed_files(cursor, table_name, file_paths):
+    cursor.execute("SELECT `file_path`, `size`, `mtime`, `content_hash` FROM `ingest_manifest` WHERE `table_name` = ?",
+                   table_name)
+    manifest = {row[0]: (row[1], row[2], row[3]) for row in cursor.fetchall()}
+
+    changed = []
+    for file_path in file_paths:
+        stat = os.stat(file_path)
+        known = manifest.get(file_path)
+        if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime:
+            continue
+        content_hash = file_hash(file_path)
+        if known is not None and known[2] == content_hash:
+            # Touched but not modified; only remember the new mtime
+            record_file(cursor, table_name, file_path, stat.st_size, stat.st_mtime, content_hash)
+            continue
+        changed.append((file_path, stat.st_size, stat.st_mtime, content_hash))
+    return changed
+
+
+# Mark a file as ingested; call once the file's rows and the rollups derived from them are written, as this
+# changes manifest_version and with it the cached query results
+def record_file(cursor, table_name, file_path, size, mtime, content_hash):
+    query = """
+        INSERT INTO `ingest_manifest` (`table_name`, `file_path`, `size`, `mtime`, `content_hash`, `loaded_at`)
+        VALUES (?, ?, ?, ?, ?, NOW())
+        ON DUPLICATE KEY UPDATE `size` = VALUES(`size`), `mtime` = VALUES(`mtime`),
+                                `content_hash` = VALUES(`content_hash`), `loaded_at` = VALUES(`loaded_at`)
+    """
+    cursor.execute(query, (table_name, file_path, size, mtime, content_hash))
+
+
+# Changes whenever a file is ingested; used to invalidate cached query results.
+# None while no reader has created ingest_manifest yet, in which case nothing can be cached.
+def manifest_version(cursor):
+    cursor.execute("SELECT COUNT(*) FROM INFORMATION_SCHEMA.TABLES "
+                   "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'ingest_manifest'")
+    if cursor.fetchone()[0] == 0:
+        return None
+    cursor.execute("SELECT COUNT(*), MAX(`loaded_at`) FROM `ingest_manifest`")
+    count, loaded_at = cursor.fetchone()
+    return f"{count}:{loaded_at}"
@@ -0,0 +1,152 @@
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+# Stage metrics are appended as JSON lines to METRICS_FILE. METRICS_PROFILE=<stage> or <stage>:<table> runs that
+# one stage under cProfile (METRICS_PROFILE_MODE=cprofile) or takes a tracemalloc snapshot of it
+# (METRICS_PROFILE_MODE=tracemalloc). METRICS_TRACEMALLOC=1 traces allocations in every stage for its peak memory.
+METRICS_FILE = os.environ.get('METRICS_FILE', './output/metrics.jsonl')
+METRICS_PROFILE = os.environ.get('METRICS_PROFILE', '')
+METRICS_PROFILE_MODE = os.environ.get('METRICS_PROFILE_MODE', 'cprofile')
+METRICS_TRACEMALLOC = os.environ.get('METRICS_TRACEMALLOC', '') == '1'
+
+# Shared by the worker processes of a run, which inherit the environment of the main process
+RUN_ID = os.environ.setdefault('METRICS_RUN_ID', datetime.now().strftime('%Y%m%dT%H%M%S') + f'-{os.getpid()}')
+
+_write_lock = threading.Lock()
+_profile_lock = threading.Lock()
+
+if METRICS_TRACEMALLOC and not tracemalloc.is_tracing():
+    tracemalloc.start()
+
+
+# Peak resident memory of this process so far in MB, or None where the resource module is missing (Windows)
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in kB elsewhere
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+# Counters of one running stage; the stage body adds the rows and bytes it handled
+class StageMetrics:
+    def __init__(self, script, stage, table=None):
+        self.script = script
+        self.stage = stage
+        self.table = table
+        self.rows = 0
+        self.bytes = 0
+        self.extra = {}
+
+    def add(self, rows=0, nbytes=0):
+        self.rows += rows
+        self.bytes += nbytes
+
+    # Iterate over a lazy source, counting the time spent waiting on it under extra[field]; used when a stage
+    # pulls its input from a reader (e.g. chunks parsed on demand) so read and write time can be told apart
+    def timed(self, iterable, field='read_seconds'):
+        self.extra.setdefault(field, 0.0)
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.extra[field] += time.perf_counter() - start
+            yield item
+
+
+def write_record(record):
+    directory = os.path.dirname(METRICS_FILE)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    line = json.dumps(record, default=str) + '\n'
+    with _write_lock:
+        with open(METRICS_FILE, 'a', encoding='utf8') as file:
+            file.write(line)
+
+
+def _profiled(stage, table):
+    return METRICS_PROFILE in (stage, f'{stage}:{table}')
+
+
+def _profile_path(script, stage, table, extension):
+    name = '_'.join(part for part in (script, stage, table) if part)
+    return os.path.join(os.path.dirname(METRICS_FILE) or '.', f'profile_{name}.{extension}')
+
+
+# Time a stage and append its metrics to the metrics file, also when the stage fails.
+# Usage: with stage('read_elmaps', 'load', 'elmaps_data') as metrics: ...; metrics.add(rows=len(df))
+@contextmanager
+def stage(script, name, table=None):
+    metrics = StageMetrics(script, name, table)
+    profiler = None
+    trace_started = False
+    # Only one stage at a time is profiled, also when stages of several tables run in parallel threads
+    profiling = _profiled(name, table) and _profile_lock.acquire(blocking=False)
+    if profiling:
+        if METRICS_PROFILE_MODE == 'tracemalloc':
+            trace_started = not tracemalloc.is_tracing()
+            if trace_started:
+                tracemalloc.start()
+        else:
+            profiler = cProfile.Profile()
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+
+    started_at = datetime.now()
+    start = time.perf_counter()
+    error = None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield metrics
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        seconds = time.perf_counter() - start
+        traced_peak = tracemalloc.get_traced_memory()[1] / 2 ** 20 if tracemalloc.is_tracing() else None
+        record = {'run_id': RUN_ID,
+                  'script': script,
+                  'stage': name,
+                  'table': table,
+                  'pid': os.getpid(),
+                  'started_at': started_at.isoformat(timespec='milliseconds'),
+                  'seconds': round(seconds, 6),
+                  'rows': metrics.rows,
+                  'bytes': metrics.bytes,
+                  'rows_per_s': round(metrics.rows / seconds, 1) if seconds > 0 else None,
+                  'peak_rss_mb': peak_rss_mb(),
+                  'traced_peak_mb': traced_peak,
+                  'error': error}
+        record.update(metrics.extra)
+        write_record(record)
+
+        if profiler is not None:
+            path = _profile_path(script, name, table, 'prof')
+            profiler.dump_stats(path)
+            print(f"Profile of stage {name} written to {path}")
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(15)
+        elif profiling:
+            print(f"Largest allocations still held at the end of stage {name}:")
+            for statistic in tracemalloc.take_snapshot().statistics('lineno')[:15]:
+                print(statistic)
+            if trace_started:
+                tracemalloc.stop()
+        if profiling:
+            _profile_lock.release()
@@ -1,28 +1,20 @@
 import pandas as pd
-import pyodbc
+import numpy as np
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib.dates import AutoDateLocator, DateFormatter
 
+from align import align_series
+from columnar_cache import ColumnarCache
+from db import close_pools, get_pool
+from downsample import downsample
+from manifest import manifest_version
+
 pd.set_option('display.width', 1000)
 pd.set_option('display.max_columns', None)
-matplotlib.use('TkAgg')  # Use a GUI backend for rendering
-
-# MySQL connection setup
-conn = pyodbc.connect('DRIVER={MySQL ODBC 8.0 ANSI Driver};SERVER=localhost;DATABASE=weather;UID=brk;PWD=12345678')
-cursor = conn.cursor()
-
-
-def odbc_init(db):
-    # Specifying the ODBC driver, server name, database, etc. directly
-    cnxn = pyodbc.connect('DRIVER={MySQL ODBC 8.0 ANSI Driver};SERVER=localhost;DATABASE='
-                          + db + ';UID=brk;PWD=12345678;Charset=utf8')
-
-    # Encoding and decoding
-    cnxn.setdecoding(pyodbc.SQL_CHAR, encoding='utf8')
-    cnxn.setdecoding(pyodbc.SQL_WCHAR, encoding='utf8')
-    cnxn.setencoding(encoding='utf8')
-    return cnxn
 
 
 # Get query as DataFrame
@@ -34,41 +26,147 @@ def df_from_sql(conn, query):
     return pd.DataFrame.from_records(rows, columns=cols)
 
 
-def main():
+# Run a (time, value) query and build typed numpy columns from the rows, fetched in chunks.
+# With a cache the result is kept until new files are ingested into the database.
+def series_from_sql(conn, query, params, chunk_size=10000, cache=None):
+    if cache is not None:
+        cursor = conn.cursor()
+        version = manifest_version(cursor)
+        cursor.close()
+        if version is not None:
+            key = cache.key(query, params, version)
+            return cache.get_or_compute(key, lambda: series_from_sql(conn, query, params, chunk_size))
+
+    cursor = conn.cursor()
+    cursor.execute(query, params)
+    times = []
+    values = []
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        chunk_times, chunk_values = zip(*rows)
+        times.append(np.array(chunk_times, dtype='datetime64[s]'))
+        values.append(np.array(chunk_values, dtype='float64'))
+    cursor.close()
+    return pd.DataFrame({'time': np.concatenate(times) if times else np.array([], dtype='datetime64[s]'),
+                         'value': np.concatenate(values) if values else np.array([], dtype='float64')})
+
+
+# Append optional [start, end) predicates on a time column to a query
+def time_range_sql(query, params, column, start=None, end=None):
+    if start is not None:
+        query += f" AND `{column}` >= ?"
+        params.append(start)
+    if end is not None:
+        query += f" AND `{column}` < ?"
+        params.append(end)
+    return query + f" ORDER BY `{column}`", params
+
+
+# One DMI parameter at one time resolution, filtered in the database
+def weather_series(conn, time_resolution, parameter_id, start=None, end=None, cache=None):
+    query = "SELECT `from`, `value` FROM `weather_data` WHERE `timeResolution` = ? AND `parameterId` = ?"
+    query, params = time_range_sql(query, [time_resolution, parameter_id], 'from', start, end)
+    return series_from_sql(conn, query, params, cache=cache)
+
+
+ELMAPS_COLUMNS = ['carbon_intensity_direct', 'carbon_intensity_lca', 'low_carbon_percentage', 'renewable_percentage']
+# Zone of the charts; the DMI data is Danish (see also rest_extract.py)
+ELMAPS_ZONE = 'DK-DK1'
+
+
+# Append a zone predicate to an elmaps_data/elmaps_rollup query. Without a zone the table must hold a single
+# zone at this resolution, as rows of several zones would be interleaved in one series.
+def zone_sql(conn, table, query, params, zone):
+    if zone is not None:
+        params.append(zone)
+        return query + " AND `zone` = ?"
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT DISTINCT `zone` FROM `{table}` WHERE `time_resolution` = ? LIMIT 2", [params[0]])
+    zones = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    if len(zones) > 1:
+        raise ValueError(f"{table} holds several zones, pass one of them as zone")
+    return query
+
+
+# One Electricity Maps metric of one zone at one time resolution, filtered in the database.
+# zone may be left out when elmaps_data holds a single zone.
+def elmaps_series(conn, time_resolution, column='carbon_intensity_direct', start=None, end=None, cache=None,
+                  zone=None):
+    if column not in ELMAPS_COLUMNS:
+        raise ValueError(f"Unknown elmaps column: {column}")
+    query = f"SELECT `datetime_utc`, `{column}` FROM `elmaps_data` WHERE `time_resolution` = ?"
+    params = [time_resolution]
+    query = zone_sql(conn, 'elmaps_data', query, params, zone)
+    query, params = time_range_sql(query, params, 'datetime_utc', start, end)
+    return series_from_sql(conn, query, params, cache=cache)
+
+
+ROLLUP_KEYS = {'weather_rollup': 'parameterId', 'elmaps_rollup': 'metric'}
+
+
+# A pre-computed day/month/year aggregate (see rollup.py); stat is 'mean', 'min', 'max' or 'count'.
+# zone selects one zone of elmaps_rollup, as in elmaps_series.
+def rollup_series(conn, table, time_resolution, key, stat='mean', start=None, end=None, cache=None, zone=None):
+    if table not in ROLLUP_KEYS or stat not in ['mean', 'min', 'max', 'count']:
+        raise ValueError(f"Unknown rollup {table}.{stat}")
+    query = f"SELECT `bucket`, `{stat}` FROM `{table}` WHERE `time_resolution` = ? AND `{ROLLUP_KEYS[table]}` = ?"
+    params = [time_resolution, key]
+    if table == 'elmaps_rollup':
+        query = zone_sql(conn, table, query, params, zone)
+    query, params = time_range_sql(query, params, 'bucket', start, end)
+    return series_from_sql(conn, query, params, cache=cache)
+
+
+# Wide table of DMI parameters and Electricity Maps metrics aligned on one time_resolution grid
+def aligned_table(conn, time_resolution, parameter_ids=(), elmaps_columns=(), start=None, end=None,
+                  how='outer', cache=None, zone=None):
+    series = {parameter_id: weather_series(conn, time_resolution, parameter_id, start, end, cache)
+              for parameter_id in parameter_ids}
+    series.update({column: elmaps_series(conn, time_resolution, column, start, end, cache, zone)
+                   for column in elmaps_columns})
+    return align_series(series, time_resolution, start, end, how)
+
+
+def main(time_resolution='month', use_rollups=False, use_cache=True, zone=ELMAPS_ZONE):
     path = 'data/Weather'
-    # Read from database
-    conn_read = odbc_init('weather')
-    weather = df_from_sql(conn_read, "SELECT * FROM weather_data;")
-    elmaps = df_from_sql(conn_read, "SELECT * FROM elmaps_data;")
-    conn_read.close()
-
-    # Adjust data
-    time_resolution = 'month'
-
-    wind_speed_tr = weather.loc[(weather['timeResolution'] == time_resolution) &
-                                (weather['parameterId'] == 'mean_wind_speed'), ['from', 'value']]
-    wind_speed_tr.columns = ['time', 'value']
-    wind_speed_tr['time'] = pd.to_datetime(wind_speed_tr['time'], errors='coerce')
-    wind_speed_tr.dropna(subset=['time'], inplace=True)
+    # Read from database; only the requested resolution and parameters leave the database.
+    # With use_rollups the series are the aggregates of the hourly rows instead of the source files' own.
+    cache = ColumnarCache() if use_cache else None
+    try:
+        with get_pool('weather').connection() as conn_read:
+            if use_rollups:
+                wind_speed_tr = rollup_series(conn_read, 'weather_rollup', time_resolution, 'mean_wind_speed',
+                                              cache=cache)
+                cloud_cover_tr = rollup_series(conn_read, 'weather_rollup', time_resolution, 'mean_cloud_cover',
+                                               cache=cache)
+                elmaps_tr = rollup_series(conn_read, 'elmaps_rollup', time_resolution, 'carbon_intensity_direct',
+                                          cache=cache, zone=zone)
+            else:
+                wind_speed_tr = weather_series(conn_read, time_resolution, 'mean_wind_speed', cache=cache)
+                cloud_cover_tr = weather_series(conn_read, time_resolution, 'mean_cloud_cover', cache=cache)
+                elmaps_tr = elmaps_series(conn_read, time_resolution, 'carbon_intensity_direct', cache=cache,
+                                          zone=zone)
+    finally:
+        close_pools()
+
     print('wind_speed:')
     print(wind_speed_tr)
-
-    cloud_cover_tr = weather.loc[(weather['timeResolution'] == time_resolution) &
-                                 (weather['parameterId'] == 'mean_cloud_cover'), ['from', 'value']]
-    cloud_cover_tr.columns = ['time', 'value']
-    cloud_cover_tr['time'] = pd.to_datetime(cloud_cover_tr['time'], errors='coerce')
-    cloud_cover_tr.dropna(subset=['time'], inplace=True)
     print('cloud_cover:')
     print(cloud_cover_tr)
-
-    elmaps_tr = elmaps.loc[elmaps['time_resolution'] == time_resolution, ['datetime_utc', 'carbon_intensity_direct']]
-    elmaps_tr.columns = ['time', 'value']
-    elmaps_tr['time'] = pd.to_datetime(elmaps_tr['time'], errors='coerce')
-    elmaps_tr.dropna(subset=['time'], inplace=True)
     print('elmaps:')
     print(elmaps_tr)
 
+    # Correlation of the series over the periods they have in common
+    aligned = align_series({'wind_speed': wind_speed_tr, 'cloud_cover': cloud_cover_tr, 'carbon_intensity': elmaps_tr},
+                           time_resolution, how='inner')
+    print('correlation:')
+    print(aligned.corr())
+
     # Plot
+    matplotlib.use('TkAgg')  # Use a GUI backend for rendering
     fig, ax = plt.subplots()
 
     ax.plot(wind_speed_tr['time'], wind_speed_tr['value'], 'x', markeredgewidth=2, label='Wind Speed')
@@ -94,5 +192,85 @@ def main():
     plt.show()
 
 
+# Charts rendered by render_all: series read from weather_data (DMI parameterIds) and elmaps_data (columns)
+CHART_SETS = {'weather_carbon': {'weather': ['mean_wind_speed', 'mean_cloud_cover'],
+                                 'elmaps': ['carbon_intensity_direct']}}
+
+
+# Render one chart to a PNG file without a display; runs in a worker process
+def render_chart(job):
+    matplotlib.use('Agg')
+    fig, ax = plt.subplots(figsize=(12, 5))
+    for label, (times, values) in job['series'].items():
+        times, values = downsample(times, values, job['max_points'], job['method'])
+        # Markers only where the individual points are still distinguishable
+        ax.plot(times, values, 'o-' if len(times) <= 200 else '-', markersize=3, linewidth=1, label=label)
+
+    ax.set_xlabel("Time")
+    ax.set_ylabel("Value")
+    ax.set_title(job['title'])
+    ax.legend()
+    ax.xaxis.set_major_locator(AutoDateLocator())
+    ax.xaxis.set_major_formatter(DateFormatter('%Y-%m-%d'))
+    fig.autofmt_xdate()
+
+    fig.savefig(job['output_path'], dpi=100)
+    plt.close(fig)
+    return job['output_path']
+
+
+# Read the series of the charts of one resolution; one job per chart set for render_chart
+def chart_jobs(conn_read, time_resolution, output_dir, chart_sets, max_points, method, use_rollups, cache, zone):
+    jobs = []
+    # There are no rollups of the hourly data at hourly resolution
+    from_rollups = use_rollups and time_resolution != 'hour'
+    for set_name, chart_set in chart_sets.items():
+        series = {}
+        for parameter_id in chart_set.get('weather', []):
+            if from_rollups:
+                series[parameter_id] = rollup_series(conn_read, 'weather_rollup', time_resolution, parameter_id,
+                                                     cache=cache)
+            else:
+                series[parameter_id] = weather_series(conn_read, time_resolution, parameter_id, cache=cache)
+        for column in chart_set.get('elmaps', []):
+            if from_rollups:
+                series[column] = rollup_series(conn_read, 'elmaps_rollup', time_resolution, column, cache=cache,
+                                               zone=zone)
+            else:
+                series[column] = elmaps_series(conn_read, time_resolution, column, cache=cache, zone=zone)
+        jobs.append({'title': f"Weather and Energy Data Over Time ({time_resolution})",
+                     'series': {label: (df['time'].to_numpy(), df['value'].to_numpy())
+                                for label, df in series.items()},
+                     'output_path': os.path.join(output_dir, f"{set_name}_{time_resolution}.png"),
+                     'max_points': max_points,
+                     'method': method})
+    return jobs
+
+
+# Render one chart per (resolution, chart set) into output_dir. The series are read here, then downsampled to
+# at most max_points per series ('minmax' or 'lttb') and drawn in parallel worker processes.
+def render_all(output_dir='./output/charts', resolutions=('hour', 'day', 'month', 'year'), chart_sets=CHART_SETS,
+               max_points=2000, method='minmax', workers=None, use_rollups=False, use_cache=True,
+               zone=ELMAPS_ZONE):
+    cache = ColumnarCache() if use_cache else None
+    jobs = []
+    try:
+        with get_pool('weather').connection() as conn_read:
+            for time_resolution in resolutions:
+                jobs += chart_jobs(conn_read, time_resolution, output_dir, chart_sets, max_points, method,
+                                   use_rollups, cache, zone)
+    finally:
+        close_pools()
+
+    os.makedirs(output_dir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=workers) as renderers:
+        for output_path in renderers.map(render_chart, jobs):
+            print(f"Saved {output_path}")
+
+
 if __name__ == '__main__':
-    main()
+    # --batch renders every chart to files without a display
+    if '--batch' in sys.argv[1:]:
+        render_all()
+    else:
+        main()
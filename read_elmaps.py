@@ -1,97 +1,265 @@
 import pandas as pd
-import numpy as np
 import pyodbc
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 import os
+import re
+import sys
+import time
+
+from db import close_pools, get_pool
+from ddl import missing_primary_key, partition_years_arg, year_partitions_sql
+from manifest import changed_files, create_manifest_table, file_info, record_file
+from metrics import stage
+from rollup import create_rollup_tables, refresh_elmaps_rollups, touched_range
 
 pd.set_option('display.width', 1000)
 pd.set_option('display.max_columns', None)
 
-# MySQL connection setup
-conn = pyodbc.connect('DRIVER={MySQL ODBC 8.0 ANSI Driver};SERVER=localhost;DATABASE=weather;UID=brk;PWD=12345678')
-cursor = conn.cursor()
+# MySQL connection; checked out from the shared pool when run as a script, see the bottom of the file
+conn = None
+cursor = None
+
+
+KEY_COLUMNS = ['time_resolution', 'zone', 'datetime_utc']
+ELMAPS_KEY = "PRIMARY KEY (" + ", ".join(f"`{col}`" for col in KEY_COLUMNS) + ")"
+STAGING_TABLE = 'elmaps_data_staging'
 
+# Electricity Maps exports are named <zone>_<year>_<resolution>.csv, e.g. DK-DK1_2023_hourly.csv;
+# the year is left out for files spanning several years. Files written by rest_extract.py end in _api.
+FILE_NAME_RE = re.compile(r'^(?P<zone>[A-Za-z0-9-]+)_(?:(?P<year>\d{4})_)?'
+                          r'(?P<resolution>hourly|daily|monthly|yearly)(?:_api)?\.csv$')
+RESOLUTIONS = {'hourly': 'hour', 'daily': 'day', 'monthly': 'month', 'yearly': 'year'}
+VALUE_COLUMNS = ['carbon_intensity_direct', 'carbon_intensity_lca', 'low_carbon_percentage', 'renewable_percentage']
 
-# Create a single table with timeResolution
-def create_table():
-    cursor.execute('DROP TABLE IF EXISTS `elmaps_data`;')
 
-    query = """
-        CREATE TABLE `elmaps_data` (
-            `time_resolution` VARCHAR(10),
-            `datetime_utc` DATETIME,
+# Create a single table with timeResolution and zone.
+# The primary key serves the plot queries (resolution, time range); with_key=False leaves it out so it can be
+# built after a bulk load. partition_years=(first, last) partitions the table by year of `datetime_utc`.
+def create_table(partition_years=None, table_name='elmaps_data', with_key=True):
+    partitions = year_partitions_sql('datetime_utc', *partition_years) if partition_years else ''
+    key = f",\n            {ELMAPS_KEY}" if with_key else ''
+    query = f"""
+        CREATE TABLE IF NOT EXISTS `{table_name}` (
+            `time_resolution` VARCHAR(10) NOT NULL,
+            `zone` VARCHAR(32) NOT NULL,
+            `datetime_utc` DATETIME NOT NULL,
             `carbon_intensity_direct` FLOAT,
             `carbon_intensity_lca` FLOAT,
             `low_carbon_percentage` FLOAT,
-            `renewable_percentage` FLOAT
-        );
+            `renewable_percentage` FLOAT{key}
+        )
+        {partitions};
     """
     cursor.execute(query)
 
 
-def write_df_to_sql(df: pd.DataFrame, connection: pyodbc.Connection, table_name: str):
+# Rows whose key already exists get update_columns overwritten instead of failing; NULLs in the new row keep the
+# stored value, as a file may lack columns another file has (e.g. the API files only have the carbon intensity)
+def write_df_to_sql(df: pd.DataFrame, connection: pyodbc.Connection, table_name: str, chunk_size: int = 10000,
+                    update_columns=None):
     cursor = connection.cursor()
+    cursor.fast_executemany = True
 
     # Generate column names for SQL insert
     columns = ", ".join(df.columns)
     placeholders = ", ".join(["?"] * len(df.columns))
     insert_sql = f"INSERT INTO {table_name} ({columns}) VALUES ({placeholders})"
+    if update_columns:
+        insert_sql += " ON DUPLICATE KEY UPDATE " + ", ".join(f"{col} = COALESCE(VALUES({col}), {col})"
+                                                            for col in update_columns)
 
-    # Write rows to the database
+    # Write rows to the database in chunks, one commit per chunk
+    rows_written = 0
+    start = time.perf_counter()
     try:
-        for _, row in df.iterrows():
-            cursor.execute(insert_sql, tuple(row))
-        connection.commit()
-        print(f"Data successfully written to {table_name}.")
+        for chunk_start in range(0, len(df), chunk_size):
+            chunk = df.iloc[chunk_start:chunk_start + chunk_size].astype(object)
+            chunk = chunk.where(chunk.notna(), None)
+            cursor.executemany(insert_sql, list(chunk.itertuples(index=False, name=None)))
+            connection.commit()
+            rows_written += len(chunk)
+        elapsed = time.perf_counter() - start
+        print(f"Data successfully written to {table_name}: {rows_written} rows in {elapsed:.1f} s "
+              f"({rows_written / max(elapsed, 1e-9):.0f} rows/s).")
+        return True
     except Exception as e:
         connection.rollback()
-        print(f"Error: {e}")
+        print(f"Error after {rows_written} rows: {e}")
+        return False
     finally:
         cursor.close()
 
 
-# Main process
-def process_files():
-    # Directory containing text files
-    directory_path = '.\\data\\Weather\\electricitymaps'
-    file_paths = sorted(glob(os.path.join(directory_path, '*.csv')))
+# (zone, year, resolution) of an Electricity Maps file from its name; year is None for multi-year files.
+# None when the name does not follow the export naming.
+def parse_file_name(file_path):
+    match = FILE_NAME_RE.match(os.path.basename(file_path))
+    if match is None:
+        return None
+    year = match.group('year')
+    return match.group('zone'), int(year) if year else None, RESOLUTIONS[match.group('resolution')]
+
+
+# elmaps_data column name of a CSV header, e.g. 'Carbon Intensity gCO₂eq/kWh (direct)' -> 'carbon_intensity_direct'
+def column_name(header):
+    return (header.replace('gCO₂eq/kWh ', '')
+            .replace('(', '')
+            .replace(')', '')
+            .replace(' ', '_')
+            .lower())
+
+
+# Read one Electricity Maps CSV file into a DataFrame shaped like elmaps_data, reading only the columns it keeps.
+# Value columns missing from the file (the API files only have the carbon intensity) are left empty.
+def read_file(file_path):
+    zone, _, resolution = parse_file_name(file_path)
+    df = pd.read_csv(file_path, usecols=lambda header: column_name(header) in ['datetime_utc'] + VALUE_COLUMNS)
+    df.columns = [column_name(header) for header in df.columns]
+    df.insert(0, 'time_resolution', resolution)
+    df.insert(1, 'zone', zone)
+    return df.reindex(columns=KEY_COLUMNS + VALUE_COLUMNS)
+
+
+# Read the Electricity Maps CSV files in parallel threads into one DataFrame shaped like elmaps_data.
+# The files are concatenated once at the end; pandas' CSV parser releases the GIL while it tokenizes.
+def read_files(file_paths, workers=None):
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        frames = list(pool.map(read_file, file_paths))
+    if not frames:
+        return pd.DataFrame(columns=KEY_COLUMNS + VALUE_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+
+# True when the table exists but was created before the zone column was added
+def missing_zone(table_name):
+    cursor.execute(f"SHOW TABLES LIKE '{table_name}'")
+    if cursor.fetchone() is None:
+        return False
+    cursor.execute(f"SHOW COLUMNS FROM `{table_name}` LIKE 'zone'")
+    return cursor.fetchone() is None
+
 
-    # Create the table
+# Bulk load into a staging table without indexes, build the primary key once, then swap the staging table
+# in with a single atomic RENAME TABLE; readers see either the old or the new data, never a partial load.
+# Rows repeated across files (e.g. a multi-year file next to the per-year files, or an export next to an API
+# file) are combined as an upsert would: each column keeps its last non-null value.
+# On failure the staging table is dropped and elmaps_data is left as it was.
+def load_and_swap(elmaps_data, partition_years=None):
+    elmaps_data = elmaps_data.groupby(KEY_COLUMNS, sort=False, as_index=False).last()
+    cursor.execute(f"DROP TABLE IF EXISTS `{STAGING_TABLE}`")
+    create_table(partition_years, STAGING_TABLE, with_key=False)
+    conn.commit()
+    with stage('read_elmaps', 'load', STAGING_TABLE) as metrics:
+        loaded = write_df_to_sql(elmaps_data, conn, STAGING_TABLE)
+        metrics.add(rows=len(elmaps_data) if loaded else 0)
+    if not loaded:
+        cursor.execute(f"DROP TABLE IF EXISTS `{STAGING_TABLE}`")
+        return False
+
+    try:
+        print("Building primary key...")
+        with stage('read_elmaps', 'index', STAGING_TABLE) as metrics:
+            cursor.execute(f"ALTER TABLE `{STAGING_TABLE}` ADD {ELMAPS_KEY}")
+            metrics.add(rows=len(elmaps_data))
+
+        print("Swapping tables...")
+        with stage('read_elmaps', 'swap', 'elmaps_data'):
+            cursor.execute("DROP TABLE IF EXISTS `elmaps_data_old`")
+            cursor.execute("SHOW TABLES LIKE 'elmaps_data'")
+            if cursor.fetchone() is not None:
+                cursor.execute(f"RENAME TABLE `elmaps_data` TO `elmaps_data_old`, `{STAGING_TABLE}` TO `elmaps_data`")
+                cursor.execute("DROP TABLE `elmaps_data_old`")
+            else:
+                cursor.execute(f"RENAME TABLE `{STAGING_TABLE}` TO `elmaps_data`")
+            conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f"Error building or swapping in {STAGING_TABLE}: {e}")
+        cursor.execute(f"DROP TABLE IF EXISTS `{STAGING_TABLE}`")
+        return False
+    return True
+
+
+# Refresh the day/month/year rollups touched by the given hourly rows; all of them when full is set
+def refresh_rollups(elmaps_data, full=False):
+    with stage('read_elmaps', 'rollup', 'elmaps_rollup'):
+        create_rollup_tables(cursor)
+        if full:
+            print("Refreshing all rollups...")
+            refresh_elmaps_rollups(cursor)
+        else:
+            hourly = pd.to_datetime(elmaps_data.loc[elmaps_data['time_resolution'] == 'hour', 'datetime_utc'])
+            start, end = touched_range([hourly.min(), hourly.max()] if len(hourly) else [])
+            if start is None:
+                return
+            print(f"Refreshing rollups from {start} to {end}...")
+            refresh_elmaps_rollups(cursor, start, end)
+        conn.commit()
+
+
+# Main process. mode='upsert' loads new or changed files into elmaps_data in place;
+# mode='swap' rebuilds the table from all files through a staging table.
+# Every zone, year and resolution found in the directory is loaded; the files are read by up to workers threads.
+def process_files(partition_years=None, mode='upsert', directory_path='./data/Weather/electricitymaps',
+                  workers=None):
+    # Directory containing the <zone>_<year>_<resolution>.csv files
+    file_paths = []
+    for file_path in sorted(glob(os.path.join(directory_path, '*.csv'))):
+        if parse_file_name(file_path) is None:
+            print(f"Skipping {file_path}: not named <zone>_<year>_<resolution>.csv")
+        else:
+            file_paths.append(file_path)
+
+    # Create the tables
     print("Creating table...")
-    create_table()
-
-    # Process each file and insert records
-    print("Processing files...")
-    elmaps_data = pd.DataFrame()
-    for file_path in file_paths:
-        print(f"Processing file: {file_path}")
-        curr_data = pd.read_csv(file_path)
-        curr_data['Time Resolution'] = file_path[39:-4]
-        elmaps_data = pd.concat([elmaps_data, curr_data])
-    elmaps_data.columns = (elmaps_data.columns
-                           .str.replace('gCO₂eq/kWh ', '')
-                           .str.replace('(', '')
-                           .str.replace(')', '')
-                           .str.replace(' ', '_')
-                           .str.lower())
-    elmaps_data = elmaps_data[['time_resolution',
-                               'datetime_utc',
-                               'carbon_intensity_direct',
-                               'carbon_intensity_lca',
-                               'low_carbon_percentage',
-                               'renewable_percentage']]
-    elmaps_data = elmaps_data.replace({'time_resolution': {'hourly': 'hour',
-                                                           'daily': 'day',
-                                                           'monthly': 'month',
-                                                           'yearly': 'year'}})
-    elmaps_data = elmaps_data.replace({np.nan: None})
-    write_df_to_sql(elmaps_data, conn, 'elmaps_data')
+    with stage('read_elmaps', 'ddl', 'elmaps_data'):
+        create_manifest_table(cursor)
+        # Tables from before the zone column or the primary key are rebuilt from all files, as upserting into them
+        # would duplicate rows; the rollups are derived data
+        if mode == 'upsert' and (missing_zone('elmaps_data') or missing_primary_key(cursor, 'elmaps_data')):
+            print("elmaps_data has no zone column or primary key yet, rebuilding it from all files...")
+            mode = 'swap'
+        if missing_zone('elmaps_rollup'):
+            cursor.execute("DROP TABLE `elmaps_rollup`")
+        if mode == 'swap':
+            file_infos = [file_info(file_path) for file_path in file_paths]
+        else:
+            create_table(partition_years)
+            file_infos = changed_files(cursor, 'elmaps_data', file_paths)
+        conn.commit()
+    if not file_infos:
+        print("No new or changed files.")
+        return
+
+    # Process the files and insert records
+    print(f"Processing {len(file_infos)} files...")
+    with stage('read_elmaps', 'extract', 'elmaps_data') as metrics:
+        elmaps_data = read_files([file_path for file_path, _, _, _ in file_infos], workers)
+        metrics.add(rows=len(elmaps_data), nbytes=sum(size for _, size, _, _ in file_infos))
+    if mode == 'swap':
+        loaded = load_and_swap(elmaps_data, partition_years)
+    else:
+        with stage('read_elmaps', 'load', 'elmaps_data') as metrics:
+            loaded = write_df_to_sql(elmaps_data, conn, 'elmaps_data', update_columns=VALUE_COLUMNS)
+            metrics.add(rows=len(elmaps_data) if loaded else 0)
+    # The files are recorded after the rollup refresh: the manifest versions the cached plot series (see
+    # manifest_version), which must not change before the rollups have caught up
+    if loaded:
+        refresh_rollups(elmaps_data, full=(mode == 'swap'))
+        for file_path, size, mtime, content_hash in file_infos:
+            record_file(cursor, 'elmaps_data', file_path, size, mtime, content_hash)
+        conn.commit()
     print("All data processed and saved.")
 
 
-# Run the process
-try:
-    process_files()
-finally:
-    conn.close()
-    print("Database connection closed.")
+# Run the process; --swap rebuilds elmaps_data from all files instead of upserting the changed ones.
+# --partition-years FIRST-LAST partitions elmaps_data by year when it is created or rebuilt.
+if __name__ == '__main__':
+    try:
+        with get_pool('weather').connection() as conn:
+            cursor = conn.cursor()
+            process_files(partition_years_arg(sys.argv[1:]), mode='swap' if '--swap' in sys.argv[1:] else 'upsert')
+    finally:
+        close_pools()
+        print("Database connection closed.")
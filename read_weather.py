@@ -1,69 +1,175 @@
-import pyodbc
 import json
 from glob import glob
 import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
 
-# MySQL connection setup
-conn = pyodbc.connect('DRIVER={MySQL ODBC 8.0 ANSI Driver};SERVER=localhost;DATABASE=weather;UID=brk;PWD=12345678')
-cursor = conn.cursor()
+from db import close_pools, get_pool
+from ddl import missing_primary_key, partition_years_arg, year_partitions_sql
+from manifest import changed_files, create_manifest_table, record_file
+from metrics import stage
+from rollup import create_rollup_tables, refresh_weather_rollups, touched_range
 
+# Use orjson for parsing when it is installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
-# Create a single table with timeResolution
-def create_table():
-    query = """
-        CREATE TABLE IF NOT EXISTS `weather_data` (
-            `from` DATETIME,
-            `to` DATETIME,
-            `timeResolution` VARCHAR(10),
-            `parameterId` VARCHAR(255),
-            `value` FLOAT
-        );
+# MySQL connection; checked out from the shared pool in the main process, see the bottom of the file
+conn = None
+cursor = None
+
+
+# Create a single table with timeResolution.
+# The primary key serves the plot queries (resolution, parameter, time range); the second index serves
+# time range queries across parameters. partition_years=(first, last) partitions the table by year of `from`.
+def create_table(partition_years=None, table_name='weather_data'):
+    partitions = year_partitions_sql('from', *partition_years) if partition_years else ''
+    query = f"""
+        CREATE TABLE IF NOT EXISTS `{table_name}` (
+            `from` DATETIME NOT NULL,
+            `to` DATETIME NOT NULL,
+            `timeResolution` VARCHAR(10) NOT NULL,
+            `parameterId` VARCHAR(255) NOT NULL,
+            `value` FLOAT,
+            PRIMARY KEY (`timeResolution`, `parameterId`, `from`, `to`),
+            KEY `idx_weather_resolution_from` (`timeResolution`, `from`)
+        )
+        {partitions};
     """
     cursor.execute(query)
 
 
-# Insert records into the table
-def insert_record(record):
-    props = record["properties"]
+# Rebuild a weather_data table from before the primary key with the key, keeping one row per observation, and
+# swap it in; upserting into the keyless table would duplicate every row
+def add_primary_key(partition_years=None):
+    print("weather_data has no primary key, rebuilding it with one...")
+    columns = "`from`, `to`, `timeResolution`, `parameterId`, `value`"
+    cursor.execute("DROP TABLE IF EXISTS `weather_data_new`")
+    create_table(partition_years, 'weather_data_new')
+    cursor.execute(f"""
+        INSERT INTO `weather_data_new` ({columns})
+        SELECT {columns} FROM `weather_data`
+        ON DUPLICATE KEY UPDATE `value` = VALUES(`value`)
+    """)
+    cursor.execute("DROP TABLE IF EXISTS `weather_data_old`")
+    cursor.execute("RENAME TABLE `weather_data` TO `weather_data_old`, `weather_data_new` TO `weather_data`")
+    cursor.execute("DROP TABLE `weather_data_old`")
+    conn.commit()
+
+
+# Parse one DMI file into (from, to, timeResolution, parameterId, value) tuples; runs in a worker process
+def parse_file(file_path):
+    rows = []
+    errors = 0
+    with stage('read_weather', 'extract', 'weather_data') as metrics:
+        with open(file_path, 'rb') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                try:
+                    props = json_loads(line)["properties"]
+                    rows.append((props["from"], props["to"],
+                                 props["timeResolution"],
+                                 props["parameterId"],
+                                 props["value"]))
+                except (ValueError, KeyError, TypeError):
+                    errors += 1
+        metrics.add(rows=len(rows), nbytes=os.path.getsize(file_path))
+        metrics.extra.update(file=file_path, errors=errors)
+    return file_path, rows, errors
+
+
+# Insert records into the table in batches, replacing the value of an already loaded observation
+def insert_rows(rows, batch_size):
     query = """
         INSERT INTO `weather_data` (`from`, `to`, `timeResolution`, `parameterId`, `value`)
         VALUES (?, ?, ?, ?, ?)
+        ON DUPLICATE KEY UPDATE `value` = VALUES(`value`)
     """
-    cursor.execute(query, (props["from"], props["to"],
-                           props["timeResolution"],
-                           props["parameterId"],
-                           props["value"]))
+    cursor.fast_executemany = True
+    for start in range(0, len(rows), batch_size):
+        cursor.executemany(query, rows[start:start + batch_size])
+        conn.commit()
 
 
 # Main process
-def process_files():
+def process_files(workers=None, batch_size=10000, partition_years=None, directory_path='./data/Weather/DMI'):
     # Directory containing text files
-    directory_path = './data/Weather/DMI'
     file_paths = sorted(glob(os.path.join(directory_path, '*.txt')))
 
-    # Create the table
+    # Create the tables
     print("Creating table...")
-    create_table()
+    with stage('read_weather', 'ddl', 'weather_data'):
+        if missing_primary_key(cursor, 'weather_data'):
+            add_primary_key(partition_years)
+        create_table(partition_years)
+        create_manifest_table(cursor)
 
-    # Process each file and insert records
-    print("Processing files...")
-    for file_path in file_paths:
-        print(f"Processing file: {file_path}")
-        with open(file_path, 'r') as file:
-            for line in file:
-                try:
-                    record = json.loads(line.strip())
-                    insert_record(record)
-                except (json.JSONDecodeError, KeyError) as e:
-                    print(f"Error in file {file_path}: {e}")
+    # Parse new or changed files in worker processes and insert their records here.
+    # At most two files per worker are parsed ahead of the inserts.
+    file_paths = changed_files(cursor, 'weather_data', file_paths)
+    conn.commit()
+    print(f"Processing {len(file_paths)} new or changed files...")
+    workers = workers or os.cpu_count() or 1
+    hourly_times = []
+    loaded_files = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        remaining = iter(file_paths)
+        for file_info in remaining:
+            pending.append((file_info, pool.submit(parse_file, file_info[0])))
+            if len(pending) >= 2 * workers:
+                break
+        while pending:
+            (file_path, size, mtime, content_hash), future = pending.popleft()
+            next_file = next(remaining, None)
+            if next_file is not None:
+                pending.append((next_file, pool.submit(parse_file, next_file[0])))
+
+            _, rows, errors = future.result()
+            with stage('read_weather', 'load', 'weather_data') as metrics:
+                insert_rows(rows, batch_size)
+                loaded_files.append((file_path, size, mtime, content_hash))
+                metrics.add(rows=len(rows), nbytes=size)
+                metrics.extra['file'] = file_path
+            print(f"Processed file: {file_path} ({len(rows)} records, {errors} malformed lines)")
 
+            # Remember the time range of the hourly rows for the rollup refresh
+            hourly_from = [row[0] for row in rows if row[2] == 'hour']
+            if hourly_from:
+                hourly_times += [datetime.fromisoformat(min(hourly_from)).replace(tzinfo=None),
+                                 datetime.fromisoformat(max(hourly_from)).replace(tzinfo=None)]
+
+    # Refresh the day/month/year rollups touched by the new hourly rows
+    start, end = touched_range(hourly_times)
+    if start is not None:
+        print(f"Refreshing rollups from {start} to {end}...")
+        with stage('read_weather', 'rollup', 'weather_rollup'):
+            create_rollup_tables(cursor)
+            refresh_weather_rollups(cursor, start, end)
+            conn.commit()
+
+    # Record the files only now: the manifest versions the cached plot series (see manifest_version), which must
+    # not change before the rollups have caught up. A file loaded but not recorded is loaded again by the next
+    # run, which only replaces the values.
+    for file_path, size, mtime, content_hash in loaded_files:
+        record_file(cursor, 'weather_data', file_path, size, mtime, content_hash)
     conn.commit()
+
     print("All data processed and saved.")
 
 
-# Run the process
-try:
-    process_files()
-finally:
-    conn.close()
-    print("Database connection closed.")
\ No newline at end of file
+# Run the process; --partition-years FIRST-LAST partitions weather_data by year when it is created
+if __name__ == '__main__':
+    try:
+        with get_pool('weather').connection() as conn:
+            cursor = conn.cursor()
+            process_files(partition_years=partition_years_arg(sys.argv[1:]))
+    finally:
+        close_pools()
+        print("Database connection closed.")
@@ -0,0 +1,241 @@
+import asyncio
+import csv
+import hashlib
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DMI_URL = 'https://dmigw.govcloud.dk/v2/climateData/collections/countryValue/items'
+ELMAPS_URL = 'https://api.electricitymap.org/v3/carbon-intensity/past-range'
+ELMAPS_ZONE = 'DK-DK1'
+
+
+# Content-addressed cache of JSON responses, keyed by URL and query parameters
+class ResponseCache:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, url, params):
+        key = hashlib.sha256(json.dumps([url, params], sort_keys=True, default=str).encode()).hexdigest()
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def get(self, url, params):
+        try:
+            with open(self.path(url, params), 'r', encoding='utf8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, url, params, data):
+        path = self.path(url, params)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+
+# Concurrent REST client: one pooled requests.Session shared by asyncio tasks,
+# a cap on requests in flight, backoff on 429/5xx, connection errors and timeouts, and an optional on-disk cache
+class RestExtractor:
+    def __init__(self, headers=None, max_concurrency=8, retries=5, backoff=1.0, cache_dir='./data/cache/rest'):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_concurrency, pool_maxsize=max_concurrency)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update(headers or {})
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.retries = retries
+        self.backoff = backoff
+        self.cache = ResponseCache(cache_dir) if cache_dir else None
+        self.requests_sent = 0
+        self.cache_hits = 0
+
+    def close(self):
+        self.session.close()
+
+    # cacheable=False skips the cache for responses that may still change, e.g. a time window that is still open
+    async def fetch(self, url, cacheable=True, **params):
+        if self.cache is not None and cacheable:
+            data = self.cache.get(url, params)
+            if data is not None:
+                self.cache_hits += 1
+                return data
+
+        async with self.semaphore:
+            for attempt in range(self.retries + 1):
+                self.requests_sent += 1
+                try:
+                    response = await asyncio.to_thread(self.session.get, url, params=params, timeout=60)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    if attempt == self.retries:
+                        raise
+                    delay = self.backoff * 2 ** attempt
+                    print(f"{type(e).__name__} from {url}, retrying in {delay:.1f} s")
+                    await asyncio.sleep(delay)
+                    continue
+                if (response.status_code != 429 and response.status_code < 500) or attempt == self.retries:
+                    break
+                # Honour Retry-After when the server sends it, otherwise back off exponentially
+                retry_after = response.headers.get('Retry-After')
+                delay = float(retry_after) if retry_after and retry_after.isdigit() else self.backoff * 2 ** attempt
+                print(f"HTTP {response.status_code} from {url}, retrying in {delay:.1f} s")
+                await asyncio.sleep(delay)
+        response.raise_for_status()
+        data = response.json()
+
+        if self.cache is not None and cacheable:
+            self.cache.put(url, params, data)
+        return data
+
+    # Fetch every page of an offset/limit paged GeoJSON endpoint. The first page gives the total
+    # ('numberMatched'); the remaining pages are then fetched concurrently.
+    async def fetch_pages(self, url, limit=10000, items_key='features', cacheable=True, **params):
+        first = await self.fetch(url, cacheable, limit=limit, offset=0, **params)
+        items = list(first.get(items_key, []))
+        total = first.get('numberMatched')
+        if total is None:
+            # No total in the response: keep requesting until a short page comes back
+            offset = limit
+            page = first
+            while len(page.get(items_key, [])) == limit:
+                page = await self.fetch(url, cacheable, limit=limit, offset=offset, **params)
+                items.extend(page.get(items_key, []))
+                offset += limit
+            return items
+
+        pages = await asyncio.gather(*[self.fetch(url, cacheable, limit=limit, offset=offset, **params)
+                                       for offset in range(limit, total, limit)])
+        for page in pages:
+            items.extend(page.get(items_key, []))
+        return items
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+# Split [start, end) into (window_start, window_end, closed) on a fixed grid of windows of the given length
+# counted from the epoch, so that the same windows, and with them the cached responses, recur from run to run.
+# The windows at the edges are clipped to [start, end); closed is False for the last window when end cuts it
+# short, as its data is still coming in.
+def time_windows(start: datetime, end: datetime, window: timedelta):
+    windows = []
+    boundary = EPOCH + (start - EPOCH) // window * window
+    while boundary < end:
+        window_end = boundary + window
+        windows.append((max(boundary, start), min(window_end, end), window_end <= end))
+        boundary = window_end
+    return windows
+
+
+def iso_utc(moment: datetime):
+    return moment.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+# DMI country values for one parameter, fetched per time window; returns GeoJSON features. Windows of 30 days
+# keep most of a recent range in closed, cacheable windows.
+async def fetch_dmi_country_values(extractor, parameter_id, start, end, time_resolution='hour',
+                                   window=timedelta(days=30)):
+    pages = await asyncio.gather(*[
+        extractor.fetch_pages(DMI_URL, cacheable=closed, parameterId=parameter_id, timeResolution=time_resolution,
+                              datetime=f"{iso_utc(window_start)}/{iso_utc(window_end)}")
+        for window_start, window_end, closed in time_windows(start, end, window)])
+    return [feature for page in pages for feature in page]
+
+
+# Electricity Maps carbon intensity history for one zone, direct and lifecycle; the API serves at most 10 days
+# and one emission factor type per request. Each record is tagged with the type it was requested with.
+async def fetch_elmaps_carbon_intensity(extractor, zone, start, end, window=timedelta(days=10),
+                                        emission_factor_types=('direct', 'lifecycle')):
+    jobs = [(factor_type, window_start, window_end, closed)
+                     for factor_type in emission_factor_types
+                     for window_start, window_end, closed in time_windows(start, end, window)]
+    pages = await asyncio.gather(*[
+        extractor.fetch(ELMAPS_URL, closed, zone=zone, start=iso_utc(window_start), end=iso_utc(window_end),
+                        emissionFactorType=factor_type)
+        for factor_type, window_start, window_end, closed in jobs])
+    return [dict(record, emissionFactorType=factor_type)
+            for (factor_type, _, _, _), page in zip(jobs, pages) for record in page.get('data', [])]
+
+
+# Write features as JSON lines, the format read_weather.py ingests
+def save_features(features, file_path):
+    with open(file_path, 'w', encoding='utf8') as f:
+        for feature in features:
+            f.write(json.dumps(feature) + '\n')
+
+
+# Columns of the Electricity Maps CSV exports that the API provides
+ELMAPS_CSV_COLUMNS = ['Datetime (UTC)', 'Zone Id', 'Carbon Intensity gCO₂eq/kWh (direct)',
+                      'Carbon Intensity gCO₂eq/kWh (LCA)', 'Data Estimated']
+
+
+# Write carbon intensity records as <zone>_<year>_hourly_api.csv files in the layout of the Electricity Maps
+# exports, which read_elmaps.py ingests. The API gives one carbon intensity per record, direct or lifecycle
+# (LCA); the records of one hour are merged into one row. Rows already in a file are kept and updated value by
+# value, so the files accumulate the history of all runs and a run fetching one type keeps the other.
+def save_carbon_intensity(records, directory, zone):
+    years = {}
+    for record in records:
+        moment = datetime.fromisoformat(record['datetime'].replace('Z', '+00:00'))
+        column = ('Carbon Intensity gCO₂eq/kWh (direct)' if record.get('emissionFactorType') == 'direct'
+                  else 'Carbon Intensity gCO₂eq/kWh (LCA)')
+        key = moment.strftime('%Y-%m-%d %H:%M:%S')
+        row = years.setdefault(moment.year, {}).setdefault(key, {'Datetime (UTC)': key, 'Zone Id': zone})
+        row[column] = record['carbonIntensity']
+        row['Data Estimated'] = record.get('isEstimated')
+    os.makedirs(directory, exist_ok=True)
+    for year, rows in years.items():
+        file_path = os.path.join(directory, f'{zone}_{year}_hourly_api.csv')
+        merged = {}
+        if os.path.exists(file_path):
+            with open(file_path, 'r', encoding='utf8', newline='') as f:
+                merged = {row['Datetime (UTC)']: row for row in csv.DictReader(f)}
+        for key, row in rows.items():
+            merged.setdefault(key, {}).update(row)
+        tmp_path = file_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf8', newline='') as f:
+            writer = csv.DictWriter(f, ELMAPS_CSV_COLUMNS)
+            writer.writeheader()
+            writer.writerows(merged[key] for key in sorted(merged))
+        os.replace(tmp_path, file_path)
+
+
+async def extract(start, end):
+    # The DMI key is optional; Electricity Maps needs a token
+    dmi_headers = {'X-Gravitee-Api-Key': os.environ['DMI_API_KEY']} if 'DMI_API_KEY' in os.environ else None
+    dmi = RestExtractor(headers=dmi_headers)
+    elmaps = RestExtractor(headers={'auth-token': os.environ['ELECTRICITYMAPS_TOKEN']})
+    try:
+        wind_speed, cloud_cover, carbon_intensity = await asyncio.gather(
+            fetch_dmi_country_values(dmi, 'mean_wind_speed', start, end),
+            fetch_dmi_country_values(dmi, 'mean_cloud_cover', start, end),
+            fetch_elmaps_carbon_intensity(elmaps, ELMAPS_ZONE, start, end))
+    finally:
+        dmi.close()
+        elmaps.close()
+    print(f"DMI: {dmi.requests_sent} requests, {dmi.cache_hits} cache hits; "
+          f"Electricity Maps: {elmaps.requests_sent} requests, {elmaps.cache_hits} cache hits")
+    return wind_speed, cloud_cover, carbon_intensity
+
+
+def main():
+    # The last 30 days from UTC midnight, so that the start and the windows after it only move once a day
+    end = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    start = (end - timedelta(days=30)).replace(hour=0)
+    t0 = time.perf_counter()
+    wind_speed, cloud_cover, carbon_intensity = asyncio.run(extract(start, end))
+    print(f"Fetched {len(wind_speed) + len(cloud_cover)} DMI features and "
+          f"{len(carbon_intensity)} carbon intensity records in {time.perf_counter() - t0:.1f} s")
+    stamp = end.strftime('%Y%m%d%H')
+    save_features(wind_speed, f'./data/Weather/DMI/mean_wind_speed_{stamp}.txt')
+    save_features(cloud_cover, f'./data/Weather/DMI/mean_cloud_cover_{stamp}.txt')
+    save_carbon_intensity(carbon_intensity, './data/Weather/electricitymaps', ELMAPS_ZONE)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+from datetime import datetime, timedelta
+
+# Day, month and year aggregates (mean, min, max, count) of the hourly rows in weather_data and elmaps_data,
+# stored in weather_rollup and elmaps_rollup. Refreshing a time range recomputes every bucket it touches.
+
+RESOLUTIONS = ['day', 'month', 'year']
+
+ELMAPS_METRICS = ['carbon_intensity_direct', 'carbon_intensity_lca', 'low_carbon_percentage', 'renewable_percentage']
+
+
+# SQL expression giving the start of the bucket a time column falls in
+def bucket_sql(column, resolution):
+    if resolution == 'day':
+        return f"TIMESTAMP(DATE(`{column}`))"
+    if resolution == 'month':
+        return f"TIMESTAMP(DATE_FORMAT(`{column}`, '%Y-%m-01'))"
+    if resolution == 'year':
+        return f"TIMESTAMP(MAKEDATE(YEAR(`{column}`), 1))"
+    raise ValueError(f"Unknown resolution: {resolution}")
+
+
+# Start of the bucket a moment falls in, and the start of the following bucket
+def bucket_bounds(moment: datetime, resolution):
+    if resolution == 'day':
+        start = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+        return start, start + timedelta(days=1)
+    if resolution == 'month':
+        start = moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        return start, (start + timedelta(days=32)).replace(day=1)
+    if resolution == 'year':
+        start = moment.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+        return start, start.replace(year=start.year + 1)
+    raise ValueError(f"Unknown resolution: {resolution}")
+
+
+# WHERE clause selecting the source rows of all buckets between start and end; everything when no range is given
+def bucket_range_sql(column, resolution, start, end, params):
+    if start is None or end is None:
+        return ''
+    params.append(bucket_bounds(start, resolution)[0])
+    params.append(bucket_bounds(end, resolution)[1])
+    return f" AND `{column}` >= ? AND `{column}` < ?"
+
+
+def create_rollup_tables(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS `weather_rollup` (
+            `time_resolution` VARCHAR(10) NOT NULL,
+            `parameterId` VARCHAR(255) NOT NULL,
+            `bucket` DATETIME NOT NULL,
+            `mean` DOUBLE,
+            `min` FLOAT,
+            `max` FLOAT,
+            `count` INT,
+            PRIMARY KEY (`time_resolution`, `parameterId`, `bucket`)
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS `elmaps_rollup` (
+            `time_resolution` VARCHAR(10) NOT NULL,
+            `zone` VARCHAR(32) NOT NULL,
+            `metric` VARCHAR(64) NOT NULL,
+            `bucket` DATETIME NOT NULL,
+            `mean` DOUBLE,
+            `min` FLOAT,
+            `max` FLOAT,
+            `count` INT,
+            PRIMARY KEY (`time_resolution`, `zone`, `metric`, `bucket`)
+        );
+    """)
+
+
+UPSERT_SQL = ("ON DUPLICATE KEY UPDATE `mean` = VALUES(`mean`), `min` = VALUES(`min`), "
+              "`max` = VALUES(`max`), `count` = VALUES(`count`)")
+
+
+# Recompute the weather_rollup buckets touched by hourly rows with `from` between start and end
+def refresh_weather_rollups(cursor, start=None, end=None):
+    for resolution in RESOLUTIONS:
+        params = [resolution]
+        query = f"""
+            INSERT INTO `weather_rollup` (`time_resolution`, `parameterId`, `bucket`, `mean`, `min`, `max`, `count`)
+            SELECT ?, `parameterId`, {bucket_sql('from', resolution)} AS `bucket`,
+                   AVG(`value`), MIN(`value`), MAX(`value`), COUNT(`value`)
+            FROM `weather_data`
+            WHERE `timeResolution` = 'hour'{bucket_range_sql('from', resolution, start, end, params)}
+            GROUP BY `parameterId`, `bucket`
+            {UPSERT_SQL}
+        """
+        cursor.execute(query, params)
+
+
+# Recompute the elmaps_rollup buckets (of every zone) touched by hourly rows with `datetime_utc` between start and end
+def refresh_elmaps_rollups(cursor, start=None, end=None):
+    for resolution in RESOLUTIONS:
+        for metric in ELMAPS_METRICS:
+            params = [resolution, metric]
+            query = f"""
+                INSERT INTO `elmaps_rollup`
+                    (`time_resolution`, `zone`, `metric`, `bucket`, `mean`, `min`, `max`, `count`)
+                SELECT ?, `zone`, ?, {bucket_sql('datetime_utc', resolution)} AS `bucket`,
+                       AVG(`{metric}`), MIN(`{metric}`), MAX(`{metric}`), COUNT(`{metric}`)
+                FROM `elmaps_data`
+                WHERE `time_resolution` = 'hour'{bucket_range_sql('datetime_utc', resolution, start, end, params)}
+                GROUP BY `zone`, `bucket`
+                {UPSERT_SQL}
+            """
+            cursor.execute(query, params)
+
+
+# Widen a (min, max) range of ingested times by a day on each side, so that time zone
+# differences between the source strings and the DATETIME columns cannot miss a bucket
+def touched_range(times):
+    times = [time for time in times if time is not None]
+    if not times:
+        return None, None
+    return min(times) - timedelta(days=1), max(times) + timedelta(days=1)
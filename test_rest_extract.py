@@ -0,0 +1,146 @@
+import asyncio
+import csv
+import json
+import os
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from rest_extract import RestExtractor, save_carbon_intensity, time_windows
+
+TOTAL_FEATURES = 25
+
+
+# Local stand-in for the REST APIs; counts the requests per path
+class StubHandler(BaseHTTPRequestHandler):
+    requests_seen = {}
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        with self.lock:
+            seen = self.requests_seen[url.path] = self.requests_seen.get(url.path, 0) + 1
+
+        if url.path == '/pages':
+            # Offset/limit paging with the total in numberMatched
+            offset, limit = int(params['offset']), int(params['limit'])
+            features = [{'id': i} for i in range(offset, min(offset + limit, TOTAL_FEATURES))]
+            self.send_json({'numberMatched': TOTAL_FEATURES, 'features': features})
+        elif url.path == '/limited':
+            # Rate limited on the first request
+            if seen == 1:
+                self.send_json({'message': 'slow down'}, 429, {'Retry-After': '1'})
+            else:
+                self.send_json({'ok': True})
+        elif url.path == '/drop':
+            # Connection closed without a response on the first request
+            if seen == 1:
+                self.close_connection = True
+            else:
+                self.send_json({'ok': True})
+        else:
+            self.send_json({'value': params.get('value')})
+
+
+class RestExtractorTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_address[1]}'
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        StubHandler.requests_seen = {}
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.extractor = RestExtractor(backoff=0.01, cache_dir=self.cache_dir.name)
+
+    def tearDown(self):
+        self.extractor.close()
+        self.cache_dir.cleanup()
+
+    def test_fetch_pages(self):
+        items = asyncio.run(self.extractor.fetch_pages(self.base_url + '/pages', limit=10))
+        self.assertEqual([item['id'] for item in items], list(range(TOTAL_FEATURES)))
+        self.assertEqual(StubHandler.requests_seen['/pages'], 3)
+
+    def test_retry_after(self):
+        data = asyncio.run(self.extractor.fetch(self.base_url + '/limited'))
+        self.assertEqual(data, {'ok': True})
+        self.assertEqual(StubHandler.requests_seen['/limited'], 2)
+        self.assertEqual(self.extractor.requests_sent, 2)
+
+    def test_retry_connection_error(self):
+        data = asyncio.run(self.extractor.fetch(self.base_url + '/drop'))
+        self.assertEqual(data, {'ok': True})
+        self.assertEqual(StubHandler.requests_seen['/drop'], 2)
+
+    def test_cache_hit(self):
+        first = asyncio.run(self.extractor.fetch(self.base_url + '/value', value='a'))
+        second = asyncio.run(self.extractor.fetch(self.base_url + '/value', value='a'))
+        self.assertEqual(first, second)
+        self.assertEqual(StubHandler.requests_seen['/value'], 1)
+        self.assertEqual(self.extractor.cache_hits, 1)
+
+    def test_open_window_not_cached(self):
+        for _ in range(2):
+            asyncio.run(self.extractor.fetch(self.base_url + '/value', cacheable=False, value='b'))
+        self.assertEqual(StubHandler.requests_seen['/value'], 2)
+        self.assertEqual(self.extractor.cache_hits, 0)
+
+
+class TimeWindowsTest(unittest.TestCase):
+    def test_windows_recur_across_runs(self):
+        window = timedelta(days=10)
+        runs = [time_windows(end - timedelta(days=30), end, window)
+                for end in [datetime(2024, 5, 20, 13, tzinfo=timezone.utc),
+                            datetime(2024, 5, 20, 17, tzinfo=timezone.utc)]]
+        closed = [{(start, end) for start, end, closed in windows[1:] if closed} for windows in runs]
+        self.assertTrue(closed[0])
+        self.assertEqual(closed[0], closed[1])
+        for windows in runs:
+            self.assertFalse(windows[-1][2])
+            for start, end, _ in windows[1:]:
+                self.assertEqual((start.hour, start.minute), (0, 0))
+
+
+class SaveCarbonIntensityTest(unittest.TestCase):
+    def test_types_merged_per_hour(self):
+        def record(intensity, factor_type):
+            return {'datetime': '2024-01-01T00:00:00.000Z', 'carbonIntensity': intensity,
+                    'emissionFactorType': factor_type, 'isEstimated': False}
+
+        with tempfile.TemporaryDirectory() as directory:
+            save_carbon_intensity([record(10, 'direct'), record(20, 'lifecycle')], directory, 'DK-DK1')
+            # A later run with only one type keeps the other
+            save_carbon_intensity([record(30, 'lifecycle')], directory, 'DK-DK1')
+            with open(os.path.join(directory, 'DK-DK1_2024_hourly_api.csv'), encoding='utf8', newline='') as f:
+                rows = list(csv.DictReader(f))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['Carbon Intensity gCO₂eq/kWh (direct)'], '10')
+        self.assertEqual(rows[0]['Carbon Intensity gCO₂eq/kWh (LCA)'], '30')
+
+
+if __name__ == '__main__':
+    unittest.main()